@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+'''
+Solves for the shutter speed and per-channel light intensities from one metering capture per color.
+
+The film base (or --roi) is metered with a high percentile of a subsampled CFA plane, which unlike a full-frame max
+isn't thrown off by a hot pixel or dust.  The light's output isn't linear in its brightness setting, so a per-rig
+response curve (raw level vs brightness, normalized to brightness 100) is measured once with --build_model and
+cached, and the solver inverts it: pick the shortest shutter speed at which every channel reaches --target of the
+white level at or below --max_brightness, then the brightness that gets each channel there.
+Without a cached curve the response is assumed to be linear.
+'''
+import argparse
+import json
+import os
+from fractions import Fraction
+import numpy as np
+from capture_negative import CaptureSession, channel_hues, load_gphoto2, make_light
+from raw_merge import channel_cfa, open_raw
+
+default_model_file = os.path.join(os.path.expanduser('~'), '.cache', 'rgb_led_filmscan', 'led_response.json')
+
+#Brightness settings measured for the response curve
+model_levels = [5, 10, 20, 35, 50, 70, 100]
+
+#Metering levels outside these fractions of the raw range are re-metered at another brightness
+clip_fraction = 0.98
+dark_fraction = 0.02
+
+def meter(raw_data, channel, roi=None, step=4, percentile=99.5):
+    #Returns (level above black, raw range above black) for the CFA sites the channel lights
+    with open_raw(raw_data) as rawfile:
+        raw_image = rawfile.raw_image
+        levels = []
+        ranges = []
+        for color in channel_cfa[channel]:
+            row, clmn = np.argwhere(rawfile.raw_pattern == color)[0]
+            plane = raw_image[row::2, clmn::2]
+            if roi is not None:
+                x0, y0, x1, y1 = roi
+                plane = plane[int(y0*plane.shape[0]):int(y1*plane.shape[0]), int(x0*plane.shape[1]):int(x1*plane.shape[1])]
+            black = rawfile.black_level_per_channel[color]
+            levels.append(np.percentile(plane[::step, ::step], percentile) - black)
+            ranges.append(rawfile.white_level - black)
+    return max(levels), min(ranges)
+
+class LedResponse:
+    '''
+    Relative light output vs brightness setting for each channel, 1.0 at brightness 100.
+    '''
+    def __init__(self, curves=None):
+        self.curves = curves or {}
+
+    def output(self, channel, bright):
+        if channel not in self.curves:
+            return bright/100.0
+        levels, outputs = zip(*self.curves[channel])
+        return float(np.interp(bright, levels, outputs))
+
+    def brightness(self, channel, output):
+        if channel not in self.curves:
+            return output*100.0
+        levels, outputs = zip(*self.curves[channel])
+        return float(np.interp(output, outputs, levels))
+
+    @staticmethod
+    def load(path, rig):
+        if path is None or not os.path.exists(path):
+            return LedResponse()
+        with open(path) as f:
+            return LedResponse(json.load(f).get(rig))
+
+    def save(self, path, rig):
+        models = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                models = json.load(f)
+        models[rig] = self.curves
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(models, f, indent=1)
+
+def build_response(session, roi=None, step=4):
+    #Median of the metered area at each brightness, relative to brightness 100.  Clipped points are left out,
+    #so pick a shutter speed where brightness 100 doesn't clip.
+    curves = {}
+    for channel in channel_hues:
+        points = []
+        for bright in model_levels:
+            level, raw_range = meter(session.capture_channel(channel, bright), channel, roi, step, percentile=50)
+            if level < clip_fraction*raw_range:
+                points.append((bright, level))
+        if len(points) < 2 or points[-1][0] != 100:
+            raise ValueError(channel + " clipped at brightness 100, use a shorter shutter speed to build the model")
+        curves[channel] = [(bright, level/points[-1][1]) for bright, level in [(0, 0.0)] + points]
+        print(channel + ": " + ", ".join("{}={:.3f}".format(b, o) for b, o in curves[channel]))
+    return LedResponse(curves)
+
+def solve_exposure(measured, rgb, shutter_speed, speeds, response, target=0.9, max_brightness=100):
+    #measured is {channel: (level, raw range)} metered at brightness rgb[channel] and shutter_speed.
+    #The light output times exposure time each channel needs to reach the target:
+    needed = {}
+    for channel, bright in zip(channel_hues, rgb):
+        level, raw_range = measured[channel]
+        needed[channel] = response.output(channel, bright)*float(Fraction(shutter_speed))*target*raw_range/max(level, 1.0)
+    for speed in sorted(speeds):
+        if all(needed[c]/float(speed) <= response.output(c, max_brightness) for c in needed):
+            break
+    else:
+        short = max(np.log2(needed[c]/(float(speed)*response.output(c, max_brightness))) for c in needed)
+        print("WARNING: even {} at brightness {} is {:.1f} stops short of the target, the frames will be underexposed".format(
+            speed, max_brightness, short))
+    #Rounded down, so a channel never ends up over the target
+    rgb = [int(np.clip(np.floor(response.brightness(c, needed[c]/float(speed))), 1, max_brightness)) for c in channel_hues]
+    return speed, rgb
+
+def auto_expose(session, rgb, roi=None, response=None, target=0.9, max_brightness=100, percentile=99.5, step=4, attempts=4):
+    #Meters each channel once, re-metering at half or double brightness if it clipped or was too dark to trust
+    response = response or LedResponse()
+    rgb = list(rgb)
+    measured = {}
+    for i, channel in enumerate(channel_hues):
+        for attempt in range(attempts):
+            level, raw_range = meter(session.capture_channel(channel, rgb[i]), channel, roi, step, percentile)
+            if level >= clip_fraction*raw_range and rgb[i] > 1:
+                retry = max(1, rgb[i]//2)
+            elif level <= dark_fraction*raw_range and rgb[i] < 100:
+                retry = min(100, rgb[i]*2)
+            else:
+                break
+            if attempt < attempts - 1:
+                rgb[i] = retry
+        #A clipped reading understates the level, and solving from it would overexpose
+        if level >= clip_fraction*raw_range:
+            raise ValueError(channel + " is still clipped at brightness " + str(rgb[i]) + ", meter at a shorter shutter speed")
+        if level <= dark_fraction*raw_range:
+            print("WARNING: " + channel + " is still very dark at brightness " + str(rgb[i]) + ", the solution may be inaccurate")
+        print("Metered {}: {:.0f} of {:.0f} at brightness {}".format(channel, level, raw_range, rgb[i]))
+        measured[channel] = (level, raw_range)
+    speed, solved = solve_exposure(measured, rgb, session.shutter_speed, session.speeds.keys(), response, target, max_brightness)
+    return session.speeds[speed], solved
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-s', '--shutter_speed', required=True,
+                    help='Shutter speed to meter at')
+    ap.add_argument('-r', '--rgb', nargs=3, type=int, default=[50, 50, 50],
+                    help='RGB intensities to meter at, 0-100')
+    ap.add_argument('-a', '--address', required=False, type=str, nargs='+',
+                    help='BLE address of Neewer light (default: the last light used, or the first one found)')
+    ap.add_argument('--light_timeout', type=float, default=10.0,
+                    help='Seconds to scan for the Neewer light before giving up.  Only a light paired with this computer is connected to without a scan')
+    ap.add_argument('--roi', type=float, nargs=4, default=None,
+                    help='Area to meter as fractions of the frame: left top right bottom (default: whole frame)')
+    ap.add_argument('-p', '--percentile', type=float, default=99.5,
+                    help='Percentile of the metered area that should land at --target')
+    ap.add_argument('--target', type=float, default=0.9,
+                    help='Fraction of the white level to put the metered percentile at')
+    ap.add_argument('--max_brightness', type=int, default=100,
+                    help='Highest light intensity the solver may use')
+    ap.add_argument('--model', default=default_model_file,
+                    help='JSON file caching the light response curves')
+    ap.add_argument('--rig', default='default',
+                    help='Name of the light/camera setup the response curve belongs to')
+    ap.add_argument('--build_model', action='store_true',
+                    help='Measure the response curve at --shutter_speed and cache it, instead of solving')
+    ap.add_argument('--simulate', action='store_true',
+                    help='Use a simulated camera and light (see simulated.py) instead of real hardware')
+
+    args = vars(ap.parse_args())
+
+    if args['simulate']:
+        from simulated import Rig
+        backend = Rig()
+        light = backend.light()
+    else:
+        backend = load_gphoto2()
+        if backend is None:
+            ap.error('gphoto2 is not installed, only --simulate is available')
+        light = make_light(args['address'])
+
+    with light:
+        with CaptureSession(light, args['shutter_speed'], backend=backend) as session:
+            print("Discovering Neewer light")
+            light.find_device(args['light_timeout'])
+            if(light.neewer_device is None):
+                exit(1)
+
+            if args['build_model']:
+                build_response(session, args['roi']).save(args['model'], args['rig'])
+                print("Saved response curves for " + args['rig'] + " to " + args['model'])
+                return
+
+            response = LedResponse.load(args['model'], args['rig'])
+            if not response.curves:
+                print("No response curves for " + args['rig'] + ", assuming the light is linear (see --build_model)")
+            shutter_speed, rgb = auto_expose(session, args['rgb'], args['roi'], response, args['target'],
+                                            args['max_brightness'], args['percentile'])
+            #Nothing waits on the light going off, leaving the light sends it before disconnecting
+            light.set_HSI(0, 100, 0, wait=False)
+
+    print("\nSolved: -s " + shutter_speed + " -r " + " ".join(str(b) for b in rgb))
+
+if __name__ == "__main__":
+    main()
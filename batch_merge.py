@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+'''
+Offline re-merge of archived red/green/blue captures into DNGs, e.g. after fixing DNG metadata.
+
+Takes either a directory of <name>_red.ARW, <name>_green.ARW, <name>_blue.ARW triples (as written by
+capture_negative.py --keep_raw), or a CSV manifest with red,green,blue[,output] columns.
+Frames whose DNG is newer than all three captures are skipped unless --force is given.
+'''
+import argparse
+import csv
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+from dng_writer import compression_modes
+from raw_merge import channel_cfa, merge_channels
+
+def find_triples(directory, output_dir):
+    triples = []
+    for name in sorted(os.listdir(directory)):
+        root, ext = os.path.splitext(name)
+        if not root.endswith('_red'):
+            continue
+        base = root[:-len('_red')]
+        files = [os.path.join(directory, base + '_' + channel + ext) for channel in channel_cfa]
+        if not all(os.path.exists(f) for f in files):
+            print("Skipping incomplete set " + base)
+            continue
+        triples.append(files + [os.path.join(output_dir or directory, base + '.dng')])
+    return triples
+
+def read_manifest(manifest, output_dir):
+    triples = []
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) == 0 or row[0].startswith('#') or row[0] == 'red':
+                continue
+            files = [os.path.join(base_dir, f.strip()) for f in row[:3]]
+            if len(row) > 3 and row[3].strip():
+                output = os.path.join(base_dir, row[3].strip())
+            else:
+                red_root = os.path.splitext(os.path.basename(files[0]))[0]
+                if red_root.endswith('_red'):
+                    red_root = red_root[:-len('_red')]
+                output = os.path.join(output_dir or os.path.dirname(files[0]), red_root + '.dng')
+            triples.append(files + [output])
+    return triples
+
+def up_to_date(triple):
+    output = triple[3]
+    if not os.path.exists(output):
+        return False
+    return os.path.getmtime(output) >= max(os.path.getmtime(f) for f in triple[:3])
+
+def merge_triple(triple, compression, tile_size, tiled=False, band_rows=256):
+    red_file, green_file, blue_file, output = triple
+    #Write to a temporary name so an interrupted batch never leaves a truncated DNG that looks up to date
+    tmp_output = output + '.tmp'
+    merge_channels(red_file, green_file, blue_file, tmp_output, compression, tile_size, verbose=False,
+                    tiled=tiled, band_rows=band_rows)
+    os.replace(tmp_output, output)
+    return output
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input', required=True,
+        help='directory of <name>_red/green/blue raw triples, or CSV manifest with red,green,blue[,output] columns')
+    ap.add_argument('-o', '--output_dir', default=None,
+        help='directory for the merged DNGs (default: next to the captures)')
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='number of merge processes')
+    ap.add_argument('-f', '--force', action='store_true',
+        help='re-merge frames even if their DNG is up to date')
+    ap.add_argument('--compression', choices=compression_modes.keys(), default='none',
+        help='Lossless DNG compression')
+    ap.add_argument('--tile_size', type=int, default=256,
+        help='Tile size for compressed DNGs')
+    ap.add_argument('--tiled', action='store_true',
+        help='Merge band by band into a memory-mapped DNG to bound memory use on very large frames (uncompressed only)')
+    ap.add_argument('--band_rows', type=int, default=256,
+        help='Rows per band with --tiled')
+
+    args = vars(ap.parse_args())
+
+    if args['tiled'] and args['compression'] != 'none':
+        ap.error('--tiled only supports uncompressed DNGs')
+
+    if os.path.isdir(args['input']):
+        triples = find_triples(args['input'], args['output_dir'])
+    else:
+        triples = read_manifest(args['input'], args['output_dir'])
+
+    if args['output_dir'] is not None:
+        os.makedirs(args['output_dir'], exist_ok=True)
+
+    todo = triples if args['force'] else [t for t in triples if not up_to_date(t)]
+    print(str(len(triples)) + " frames, " + str(len(triples) - len(todo)) + " up to date, merging " + str(len(todo)))
+    if len(todo) == 0:
+        return
+
+    failed = 0
+    start = perf_counter()
+    #rawpy's OpenMP runtime can deadlock in forked workers
+    with ProcessPoolExecutor(max_workers=args['jobs'], mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(merge_triple, t, args['compression'], args['tile_size'],
+                                    args['tiled'], args['band_rows']): t for t in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                output = future.result()
+                print("[{}/{}] {}".format(done, len(todo), output))
+            except Exception as e:
+                failed += 1
+                print("[{}/{}] Failed to merge {}: {}".format(done, len(todo), futures[future][0], e))
+    elapsed = perf_counter() - start
+
+    merged = len(todo) - failed
+    print("Merged {} frames in {:.1f}s, {:.2f} frames/s".format(merged, elapsed, merged/elapsed))
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks whole roll captures against the simulated camera and light, so changes to pipelining, compression
+and merging can be measured without the copy stand.  Every combination of --workers and --compression is run
+as a roll of --frames frames and reported as frames/min with its peak memory, with -v also the per-stage timings.
+'''
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+from fractions import Fraction
+from functools import partial
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from capture_negative import CaptureSession, channel_hues, profiled
+from dng_writer import compression_modes
+from frame_pipeline import FramePipeline
+from profiling import peak_rss, profiler
+from raw_merge import merge_channels
+from simulated import Rig
+
+def run_roll(rig, args, workers, compression, output_dir):
+    merge = partial(merge_channels, compression=compression, verbose=False,
+                    tiled=args['tiled'], band_rows=args['band_rows'])
+    light = rig.light(acknowledge=not args['no_ack'])
+    profiler.enable()
+    with light:
+        with CaptureSession(light, args['shutter_speed'], args['led_settle'], backend=rig) as session:
+            light.find_device()
+            start = perf_counter()
+            with FramePipeline(profiled(merge), workers=workers, depth=args['queue_depth']) as pipeline:
+                for frame in range(args['frames']):
+                    output = os.path.join(output_dir, 'frame_{:03d}.dng'.format(frame))
+                    with profiler.frame(output):
+                        captures = session.capture_frame(args['rgb'], output)
+                        with profiler.stage('queue_wait'):
+                            pipeline.submit(*captures, output)
+            elapsed = perf_counter() - start
+    return elapsed, peak_rss()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--frames', type=int, default=5,
+        help='Frames per roll')
+    ap.add_argument('--workers', type=int, nargs='+', default=[1, 2],
+        help='Merge worker counts to compare')
+    ap.add_argument('--compression', choices=compression_modes.keys(), nargs='+', default=['none'],
+        help='DNG compression modes to compare')
+    ap.add_argument('--queue_depth', type=int, default=2,
+        help='Frames waiting for a merge worker before capture blocks')
+    ap.add_argument('--tiled', action='store_true',
+        help='Use the tiled, memory-mapped merge (uncompressed only)')
+    ap.add_argument('--band_rows', type=int, default=256,
+        help='Rows per band with --tiled')
+    ap.add_argument('--shape', type=int, nargs=2, default=[4000, 6000],
+        help='Simulated sensor height and width')
+    ap.add_argument('-s', '--shutter_speed', default='1/60',
+        help='Shutter speed')
+    ap.add_argument('-r', '--rgb', type=int, nargs=3, default=[60, 60, 60],
+        help='Light intensities')
+    ap.add_argument('--led_settle', type=float, default=0.05,
+        help='LED settle time in seconds')
+    ap.add_argument('--no_ack', action='store_true',
+        help="Don't wait for the simulated light's acknowledgement")
+    ap.add_argument('--shutter_latency', type=float, default=0.15,
+        help='Simulated trigger to file added latency on top of the exposure, in seconds')
+    ap.add_argument('--transfer_rate', type=float, default=40.0,
+        help='Simulated USB transfer rate in MB/s')
+    ap.add_argument('--light_latency', type=float, default=0.03,
+        help='Simulated light command latency in seconds')
+    ap.add_argument('-v', '--verbose', action='store_true',
+        help='Print the per-stage timings of every run')
+
+    args = vars(ap.parse_args())
+
+    if args['tiled'] and args['compression'] != ['none']:
+        ap.error('--tiled only supports uncompressed DNGs')
+
+    rig = Rig(shape=tuple(args['shape']), shutter_latency=args['shutter_latency'],
+            transfer_rate=args['transfer_rate']*1e6, light_latency=args['light_latency'])
+    #Render the captures up front so the first roll doesn't pay for it
+    for hue, bright in zip(channel_hues.values(), args['rgb']):
+        rig.illumination = (hue, 100, bright)
+        rig.render(Fraction(args['shutter_speed']))
+
+    print("Simulated {}x{} sensor, {} frames per roll".format(args['shape'][1], args['shape'][0], args['frames']))
+    print("{:<10}{:>8}{:>12}{:>14}".format('mode', 'workers', 'frames/min', 'peak RSS (MB)'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for compression in args['compression']:
+            for workers in args['workers']:
+                #The capture path's progress messages would drown out the results
+                with contextlib.redirect_stdout(io.StringIO()):
+                    elapsed, peak = run_roll(rig, args, workers, compression, tmpdir)
+                print("{:<10}{:>8d}{:>12.1f}{:>14.0f}".format(compression, workers, args['frames']*60/elapsed, peak/1e6))
+                if args['verbose']:
+                    print(profiler.summary())
+                    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks the DNG writer's compression modes, reporting throughput and file size for each.
+Uses the CFA mosaic of an existing DNG if given one, otherwise a synthetic negative-like mosaic.
+'''
+import argparse
+import os
+import sys
+import tempfile
+from time import perf_counter
+import numpy as np
+import tifffile as TIFF
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dng_writer import compression_modes, write_dng
+
+def synthetic_mosaic(height, width):
+    #Smooth gradients plus grain-like noise, so compression ratios are in the ballpark of a real scan
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    mosaic = 4000 + 3000*np.sin(x/(width/7.0))*np.cos(y/(height/5.0))
+    mosaic += rng.normal(0, 40, (height, width))
+    mosaic[0::2, 0::2] *= 1.3
+    mosaic[1::2, 1::2] *= 0.7
+    return np.clip(mosaic, 512, 16383).astype(np.uint16)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input', default=None,
+        help='DNG to take the CFA mosaic from (default: synthetic 6048x4024 mosaic)')
+    ap.add_argument('-n', '--repeat', type=int, default=3,
+        help='Number of writes per mode, the fastest is reported')
+    ap.add_argument('--tile_size', type=int, default=256,
+        help='Tile size for compressed modes')
+    ap.add_argument('--workers', type=int, default=None,
+        help='Compression threads (default: tifffile default)')
+
+    args = vars(ap.parse_args())
+
+    if args['input'] is not None:
+        bayer_data = TIFF.imread(args['input'])
+    else:
+        bayer_data = synthetic_mosaic(4024, 6048)
+
+    pattern = np.array([[0, 1], [1, 2]], dtype=np.uint8)
+    dng_extratags = [('CFARepeatPatternDim', 'H', 2, pattern.shape, 0),
+                     ('CFAPattern', 'B', pattern.size, pattern.flatten()),
+                     ('WhiteLevel', 'H', 1, 16383),
+                     ('DNGVersion', 'B', 4, [1,4,0,0]),
+                     ('DNGBackwardVersion', 'B', 4, [1,4,0,0])]
+
+    raw_mb = bayer_data.nbytes/1e6
+    print("Mosaic: " + str(bayer_data.shape) + ", {:.1f} MB".format(raw_mb))
+    print("{:<10}{:>10}{:>12}{:>10}".format('mode', 'MB/s', 'size (MB)', 'ratio'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mode in compression_modes:
+            output = os.path.join(tmpdir, mode + '.dng')
+            best = None
+            for i in range(args['repeat']):
+                start = perf_counter()
+                write_dng(output, bayer_data, dng_extratags, mode, args['tile_size'], args['workers'])
+                elapsed = perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            size_mb = os.path.getsize(output)/1e6
+            print("{:<10}{:>10.1f}{:>12.1f}{:>10.2f}".format(mode, raw_mb/best, size_mb, raw_mb/size_mb))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+'''
+Import time budget check for the filmscan.py commands, for running before committing changes to imports.
+
+Each command's script is imported in a fresh interpreter, and the check fails if it loads one of the packages it
+has no business loading at import time, or if `filmscan.py <command> -h` takes longer than its budget (best of
+--runs, including interpreter startup).  The budgets are for a desktop machine, use --scale on slower ones.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo_dir)
+from filmscan import commands
+
+#Only ever needed once a command is running, and slow to import (or, for the hardware ones, slow to initialise)
+heavy_modules = ['matplotlib', 'scipy', 'pandas', 'gphoto2', 'simplepyble', 'rawpy', 'tifffile', 'PIL']
+
+#Milliseconds for `filmscan.py <command> -h`, None being `filmscan.py -h`
+budgets = {None: 100}
+budgets.update({command: 400 for command in commands})
+
+probe = '''
+import json, sys
+from time import perf_counter
+start = perf_counter()
+import {module}
+print(json.dumps([perf_counter() - start, sorted(m for m in sys.modules if '.' not in m)]))
+'''
+
+def import_module(module):
+    #Returns (import time, top level modules loaded) from a fresh interpreter
+    result = subprocess.run([sys.executable, '-c', probe.format(module=module)], cwd=repo_dir,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+def help_time(command, runs):
+    argv = [sys.executable, os.path.join(repo_dir, 'filmscan.py')] + ([command] if command else []) + ['-h']
+    best = None
+    for run in range(runs):
+        start = perf_counter()
+        subprocess.run(argv, cwd=repo_dir, stdout=subprocess.DEVNULL, check=True)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--runs', type=int, default=3,
+        help='Runs of each command, the fastest is used')
+    ap.add_argument('--scale', type=float, default=1.0,
+        help='Multiplier for the time budgets')
+
+    args = vars(ap.parse_args())
+
+    failures = []
+    seconds, loaded = import_module('filmscan')
+    if 'numpy' in loaded:
+        failures.append('filmscan imports numpy')
+
+    print("{:<11}{:<21}{:>10}{:>10}{:>10}".format('command', 'module', 'import ms', '-h ms', 'budget'))
+    for command in [None] + list(commands):
+        module = commands[command][0] if command else 'filmscan'
+        if command:
+            seconds, loaded = import_module(module)
+        heavy = [m for m in heavy_modules if m in loaded]
+        if heavy:
+            failures.append(module + ' imports ' + ', '.join(heavy))
+        elapsed = help_time(command, args['runs'])
+        budget = budgets[command]*args['scale']
+        if elapsed*1000 > budget:
+            failures.append("{} -h took {:.0f} ms, budget {:.0f} ms".format(command or 'filmscan', elapsed*1000, budget))
+        print("{:<11}{:<21}{:>10.0f}{:>10.0f}{:>10.0f}".format(command or '', module, seconds*1000, elapsed*1000, budget))
+
+    if failures:
+        print('\n'.join(['', 'Over budget:'] + failures))
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+'''
+Headless batch version of density_plot.py: fits every <film>_density.csv in film_data/ and any other given
+directories in parallel, and writes the profiles to the profile store that invert_negative.py loads them from
+(see film_model.py), under the <film> part of the file name.  A film found in more than one directory takes
+the profile from the last one.
+
+Fits are cached by density_plot.py, so only new or changed CSVs are refitted.  With --plot_dir, the fit plots
+are rendered to PNGs there instead of being shown.
+'''
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from density_plot import cached_fit, default_fit_cache_dir, plot_fit, scene_curves
+from film_model import default_profile_store, read_profile_store, write_profile_store
+
+default_film_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'film_data')
+
+density_suffix = '_density.csv'
+
+def find_density_csvs(directories):
+    films = {}
+    for directory in directories:
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(density_suffix):
+                films[name[:-len(density_suffix)]] = os.path.join(directory, name)
+    return films
+
+def fit_film(film, path, dmin, dmax, cache_dir, plot_dir):
+    #Returns (film, profile or None, error message or None), so one bad CSV doesn't stop the batch
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        curves = None
+        if plot_dir is not None:
+            curves = scene_curves(data)
+        profile = cached_fit(data, dmin, dmax, cache_dir, curves)
+        if plot_dir is not None:
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+            fig, axs = plot_fit(film, profile, *curves, dmin, dmax)
+            fig.set_size_inches(16, 10)
+            fig.savefig(os.path.join(plot_dir, film + '.png'), dpi=100)
+            plt.close(fig)
+        return film, profile, None
+    except Exception as e:
+        return film, None, str(e)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input', nargs='*', default=[],
+        help='directories of <film>_density.csv files, in addition to film_data/')
+    ap.add_argument('--no_film_data', action='store_true',
+        help="don't fit the CSVs in film_data/")
+    ap.add_argument('-o', '--store', default=default_profile_store,
+        help='profile store to write')
+    ap.add_argument('--replace', action='store_true',
+        help='drop profiles already in the store instead of updating it')
+    ap.add_argument('--dmax', type=float, default=1.5,
+        help='maximum density for exponent fitting')
+    ap.add_argument('--dmin', type=float, default=0.5,
+        help='minimum density for exponent fitting')
+    ap.add_argument('--plot_dir', default=None,
+        help='render the fit plots to <film>.png in this directory')
+    ap.add_argument('--cache_dir', default=default_fit_cache_dir,
+        help='Directory caching fit results')
+    ap.add_argument('--no_cache', action='store_true',
+        help='Always refit')
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='number of fitting processes')
+
+    args = vars(ap.parse_args())
+
+    directories = ([] if args['no_film_data'] else [default_film_dir]) + args['input']
+    films = find_density_csvs(directories)
+    if len(films) == 0:
+        ap.error('no *' + density_suffix + ' files found')
+    if args['plot_dir'] is not None:
+        os.makedirs(args['plot_dir'], exist_ok=True)
+
+    cache_dir = None if args['no_cache'] else args['cache_dir']
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=args['jobs']) as executor:
+        n = len(films)
+        results = list(executor.map(fit_film, films.keys(), films.values(), [args['dmin']]*n, [args['dmax']]*n,
+                                    [cache_dir]*n, [args['plot_dir']]*n,
+                                    chunksize=max(1, n//(4*args['jobs']))))
+    elapsed = perf_counter() - start
+
+    profiles = {} if args['replace'] else read_profile_store(args['store'])
+    failed = 0
+    for film, profile, error in results:
+        if profile is None:
+            failed += 1
+            print("Failed to fit " + films[film] + ": " + error)
+        else:
+            profiles[film] = profile
+    write_profile_store(profiles, args['store'])
+
+    print("Fitted {} films in {:.1f}s, {} profiles in {}".format(len(films) - failed, elapsed, len(profiles), args['store']))
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
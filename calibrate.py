@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+'''
+Captures master dark and flat field frames for capture_negative.py --flat_field.
+
+Take the film out of the holder (or put a clear piece of film base in it), then run with the same shutter speed
+and RGB intensities as the roll.  Each LED color is captured --frames times and only the CFA sites that color
+contributes to the merged mosaic are averaged, the dark frames are taken with the light off.
+'''
+import argparse
+import logging
+import numpy as np
+from capture_negative import CaptureSession, channel_hues, load_gphoto2, make_light
+from raw_merge import channel_cfa, open_raw
+from dng_writer import read_exif
+from calibration import CalibrationStore, StreamingMean, default_calibration_dir, exif_camera_model, exif_exposure_time, gain_from_flat
+
+def accumulate(mean, raw_data, channel=None):
+    #Decode one capture at a time, so memory use doesn't grow with --frames
+    with open_raw(raw_data) as rawfile:
+        if channel is None:
+            mean.add(rawfile.raw_image)
+        else:
+            for color in channel_cfa[channel]:
+                row, clmn = np.argwhere(rawfile.raw_pattern == color)[0]
+                mean.add(rawfile.raw_image, row, clmn)
+
+def main():
+    logging.basicConfig(
+        format='%(levelname)s: %(name)s: %(message)s', level=logging.ERROR)
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-s', '--shutter_speed', required=True,
+                    help='Shutter Speed')
+    ap.add_argument('-r', '--rgb', required=True, nargs=3, type=int,
+                    help='RGB intensities for Neewer light, 0-100')
+    ap.add_argument('-n', '--frames', type=int, default=8,
+                    help='Number of frames averaged for each master')
+    ap.add_argument('-a', '--address', required=False, type=str, nargs='+',
+                    help='BLE address of Neewer light (default: the last light used, or the first one found)')
+    ap.add_argument('--no_ack', action='store_true',
+                    help="Don't wait for the light to acknowledge commands")
+    ap.add_argument('--light_timeout', type=float, default=10.0,
+                    help='Seconds to scan for the Neewer light before giving up.  Only a light paired with this computer is connected to without a scan')
+    ap.add_argument('--led_settle', type=float, default=0.05,
+                    help='Seconds to wait for the LEDs to settle after a color change')
+    ap.add_argument('--calibration_dir', default=default_calibration_dir,
+                    help='Directory to store the master frames in')
+    ap.add_argument('--simulate', action='store_true',
+                    help='Use a simulated camera and light (see simulated.py) instead of real hardware')
+
+    args = vars(ap.parse_args())
+
+    if args['simulate']:
+        from simulated import Rig
+        backend = Rig()
+        light = backend.light(acknowledge=not args['no_ack'])
+    else:
+        backend = load_gphoto2()
+        if backend is None:
+            ap.error('gphoto2 is not installed, only --simulate is available')
+        light = make_light(args['address'], args['no_ack'])
+    callback_obj = backend.check_result(backend.use_python_logging())
+
+    store = CalibrationStore(args['calibration_dir'], args['rgb'])
+    with light:
+        with CaptureSession(light, args['shutter_speed'], args['led_settle'], backend=backend) as session:
+            print("Discovering Neewer light")
+            light.find_device(args['light_timeout'])
+            if(light.neewer_device is None):
+                exit(1)
+
+            flat = StreamingMean()
+            exif = None
+            for channel, bright in zip(channel_hues.keys(), args['rgb']):
+                for i in range(args['frames']):
+                    print("Flat " + channel + " " + str(i + 1) + "/" + str(args['frames']))
+                    raw_data = session.capture_channel(channel, bright)
+                    if exif is None:
+                        exif = read_exif(raw_data)
+                    accumulate(flat, raw_data, channel)
+            flat = flat.mean()
+
+            #Brightness 0 switches the LEDs off
+            dark = StreamingMean()
+            for i in range(args['frames']):
+                print("Dark " + str(i + 1) + "/" + str(args['frames']))
+                accumulate(dark, session.capture_channel('red', 0))
+            dark = dark.mean()
+
+    key = store.save(exif_camera_model(exif), exif_exposure_time(exif), args['rgb'], dark, gain_from_flat(flat, dark))
+    print("Saved calibration " + key + " to " + args['calibration_dir'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+'''
+Master dark and flat field frames, applied while merging.
+
+Masters are stored as float32 .npy mosaics, a dark frame and a gain frame (the normalized inverse of the flat),
+keyed by camera model, exposure time and RGB light intensities, and loaded memory-mapped so applying
+them to a band only touches that band's pages.
+'''
+import os
+import re
+from fractions import Fraction
+import numpy as np
+
+default_calibration_dir = os.path.join(os.path.expanduser('~'), '.cache', 'rgb_led_filmscan', 'calibration')
+
+def calibration_key(camera_model, exposure_time, rgb):
+    exposure = Fraction(exposure_time)
+    key = '{}_{}-{}s_{}-{}-{}'.format(camera_model, exposure.numerator, exposure.denominator, *rgb)
+    return re.sub(r'[^A-Za-z0-9_.-]+', '-', key)
+
+def exif_camera_model(exif):
+    return exif.get('Make', '').strip() + ' ' + exif.get('Model', '').strip()
+
+def exif_exposure_time(exif):
+    return Fraction(*exif['ExposureTime'])
+
+class StreamingMean:
+    #Running sum of a mosaic, so averaging N captures costs one float32 frame rather than N
+    def __init__(self):
+        self.sum = None
+        self.count = None
+
+    def add(self, raw_image, row=None, clmn=None):
+        #Either the whole mosaic or just one CFA site of it
+        if self.sum is None:
+            self.sum = np.zeros(raw_image.shape, dtype=np.float32)
+            self.count = np.zeros((2, 2), dtype=np.int32)
+        if row is None:
+            self.sum += raw_image
+            self.count += 1
+        else:
+            self.sum[row::2, clmn::2] += raw_image[row::2, clmn::2]
+            self.count[row, clmn] += 1
+
+    def mean(self):
+        mean = self.sum
+        for row in range(2):
+            for clmn in range(2):
+                mean[row::2, clmn::2] /= max(1, self.count[row, clmn])
+        self.sum = None
+        return mean
+
+def gain_from_flat(flat, dark):
+    #Per CFA site gain that flattens the light field while keeping each site's average level
+    signal = flat - dark
+    np.maximum(signal, 1.0, out=signal)
+    gain = np.empty_like(signal)
+    for row in range(2):
+        for clmn in range(2):
+            site = signal[row::2, clmn::2]
+            gain[row::2, clmn::2] = np.mean(site, dtype=np.float64)/site
+    return gain
+
+class Calibration:
+    def __init__(self, dark, gain):
+        self.dark = dark
+        self.gain = gain
+        #The dark frame carries the black level pedestal, put its average back so the DNG's BlackLevel stays valid
+        self.pedestal = np.array([[np.mean(dark[row::2, clmn::2], dtype=np.float64) for clmn in range(2)] for row in range(2)],
+                                dtype=np.float32)
+
+    def __call__(self, plane, band, row, clmn):
+        #plane is the view of CFA site (row, clmn) of the given band of rows, corrected in place.
+        #Float planes (multi-shot stacks) keep their fractional part, raw uint16 planes are rounded.
+        dark = self.dark[band][row::2, clmn::2]
+        gain = self.gain[band][row::2, clmn::2]
+        corrected = plane - dark
+        corrected *= gain
+        corrected += self.pedestal[row, clmn]
+        np.clip(corrected, 0, 65535, out=corrected)
+        plane[...] = corrected if plane.dtype.kind == 'f' else np.rint(corrected)
+
+class CalibrationStore:
+    def __init__(self, calibration_dir=default_calibration_dir, rgb=None):
+        self.calibration_dir = calibration_dir
+        self.rgb = rgb
+        self.loaded = {}
+
+    def paths(self, key):
+        return (os.path.join(self.calibration_dir, key + '.dark.npy'),
+                os.path.join(self.calibration_dir, key + '.gain.npy'))
+
+    def save(self, camera_model, exposure_time, rgb, dark, gain):
+        os.makedirs(self.calibration_dir, exist_ok=True)
+        key = calibration_key(camera_model, exposure_time, rgb)
+        for path, data in zip(self.paths(key), (dark, gain)):
+            np.save(path, data.astype(np.float32))
+        return key
+
+    def load(self, camera_model, exposure_time, rgb):
+        key = calibration_key(camera_model, exposure_time, rgb)
+        if key not in self.loaded:
+            dark_path, gain_path = self.paths(key)
+            if not (os.path.exists(dark_path) and os.path.exists(gain_path)):
+                raise FileNotFoundError("No calibration frames for " + key + " in " + self.calibration_dir + ", run calibrate.py first")
+            self.loaded[key] = Calibration(np.load(dark_path, mmap_mode='r'), np.load(gain_path, mmap_mode='r'))
+        return self.loaded[key]
+
+    def lookup(self, exif):
+        #Calibration matching the camera and exposure a capture was taken with
+        return self.load(exif_camera_model(exif), exif_exposure_time(exif), self.rgb)
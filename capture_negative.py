@@ -4,240 +4,547 @@
 Tri-color capture tool inspired by https://discuss.pixls.us/t/digitizing-film-using-dslr-and-rgb-led-lights/18825
 '''
 import argparse
-from time import sleep
-import rawpy
-import gphoto2 as gp
-import numpy as np
+import os
+from time import sleep, monotonic
 from fractions import Fraction
 import logging
-from neewer_light import NeewerLight
-import tifffile as TIFF
-import pyexiv2
-
-def empty_event_queue(camera):
+import math
+from neewer_light import NeewerLight, NeewerLightGroup, format_latency_histogram
+from frame_pipeline import FramePipeline
+from dng_writer import compression_modes, read_exif
+from raw_merge import ChannelStack, merge_channels, merge_stacks
+from calibration import CalibrationStore, default_calibration_dir, exif_camera_model, exif_exposure_time
+from registration import format_shifts, misregistered
+from profiling import profiler
+from roll_journal import RollJournal
+from functools import partial
+
+#Hue for each capture channel when driving the light in HSI mode
+channel_hues = {'red': 0, 'green': 120, 'blue': 240}
+
+log = logging.getLogger('capture_negative')
+
+def load_gphoto2():
+    #Imported when a camera is actually used, so -h and --simulate never load libgphoto2.  None if it isn't installed,
+    #only --simulate works then.
+    try:
+        import gphoto2
+    except ImportError:
+        return None
+    return gphoto2
+
+def wait_for_event(backend, camera, wanted, timeout):
+    #Waits for one of the wanted gphoto2 events, returning (type, data) or (None, None) on timeout
+    deadline = monotonic() + timeout
     while True:
-        type_, data = camera.wait_for_event(10)
-        if type_ == gp.GP_EVENT_TIMEOUT:
-            return
-        if type_ == gp.GP_EVENT_FILE_ADDED:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return None, None
+        type_, data = camera.wait_for_event(max(1, int(remaining*1000)))
+        if type_ in wanted:
+            return type_, data
+        if type_ == backend.GP_EVENT_FILE_ADDED:
             # get a second image if camera is set to raw + jpeg
             print('Unexpected new file', data.folder + data.name)
 
-#fugly, find a better solution for generating RATIONAL/SRATIONAL
-def cm_to_flatrational(input_array):
-    retarray = np.ones(input_array.size*2, dtype=np.int32)
-    retarray[0::2] = (input_array.flatten()*10000).astype(np.int32)
-    retarray[1::2] = 10000
-    return retarray
-
-logging.basicConfig(
-    format='%(levelname)s: %(name)s: %(message)s', level=logging.ERROR)
-callback_obj = gp.check_result(gp.use_python_logging())
-
-
-ap = argparse.ArgumentParser()
-ap.add_argument('-o', '--output', required=True,
-    help='path to output DNG')
-ap.add_argument('-s', '--shutter_speed', required=True,
-                help='Shutter Speed')
-ap.add_argument('-r', '--rgb', required=True, nargs=3, type=int,
-                help='RGB intensities for Neewer light, 0-100')
-ap.add_argument('-a', '--address', required=False, type=str,
-                help='BLE address of Neewer light')
-
-args = vars(ap.parse_args())
-
-with NeewerLight(address=args['address']) as light:
-    print("Initializing camera")
-    camera = gp.Camera()
-    camera.init()
-    print("Discovering Neewer light")
-    light.find_device()
-    if(light.neewer_device is None):
-        print("No device found")
-        exit(0)
-
-    print("Neewer light found")
-
-
-    print ("Configuring camera")
-    # get configuration tree
-    cfg = camera.get_config()
-    capturetarget_cfg = cfg.get_child_by_name('capturetarget')
-    capturetarget_cfg.set_value('sdram')
-    camera.set_config(cfg)
-    shutterspeed_cfg = cfg.get_child_by_name('shutterspeed')
-    speeds_byname = []
-    speeds = []
-    for j in range(shutterspeed_cfg.count_choices()):
-        choice = shutterspeed_cfg.get_choice(j)
-        if choice != 'Bulb':
-            speeds_byname.append(choice)
-            speeds.append(Fraction(choice))
-    idx = speeds.index(Fraction(args['shutter_speed']))
-    shutterspeed_cfg.set_value(speeds_byname[idx])
-    print("Setting shutter speed")
-    camera.set_config(cfg)
-
-    print()
-    light.set_HSI(0, 100, args['rgb'][0])
-    sleep(0.1)
-
-    path = camera.capture(gp.GP_CAPTURE_IMAGE)
-    camera_file = camera.file_get(path.folder, path.name, gp.GP_FILE_TYPE_NORMAL)
-    camera_file.save('red.ARW')
-    sleep(0.1)
-    camera.file_delete(path.folder, path.name)
-    empty_event_queue(camera)
-
-    rawfile = rawpy.imread('red.ARW')
-
-    bayer_pattern = rawfile.raw_pattern
-    bayer_data = rawfile.raw_image.astype('uint16')
-
-    iRrow,  iRclmn  = np.argwhere(bayer_pattern == 0)[0]
-
-    R  = bayer_data[ iRrow::2,  iRclmn::2]
-
-    print("Red max:" + str(np.amax(R)))
-    print("Red min:" + str(np.amin(R)))
-
-    print()
-    light.set_HSI(120, 100, args['rgb'][1])
-    sleep(0.1)
-
-    empty_event_queue(camera)
-    print("\nCapturing green")
-    path = camera.capture(gp.GP_CAPTURE_IMAGE)
-    print("Captured")
-    camera_file = camera.file_get(path.folder, path.name, gp.GP_FILE_TYPE_NORMAL)
-    camera_file.save('green.ARW')
-    sleep(0.2)
-    camera.file_delete(path.folder, path.name)
-
-
-
-    rawfile = rawpy.imread('green.ARW')
-
-    bayer_pattern = rawfile.raw_pattern
-    bayer_data = rawfile.raw_image.astype('uint16')
-
-    iG0row, iG0clmn = np.argwhere(bayer_pattern == 1)[0]
-    iG1row, iG1clmn = np.argwhere(bayer_pattern == 3)[0]
-
-    G = bayer_data[iG0row::2, iG0clmn::2]
-    G1 = bayer_data[iG1row::2, iG1clmn::2]
-
-    print("Green max:" + str(np.amax(G)))
-    print("Green2 max:" + str(np.amax(G1)))
-    print("Green min:" + str(np.amin(G)))
-    print("Green2 min:" + str(np.amin(G1)))
-
-    print()
-    light.set_HSI(240, 100, args['rgb'][2])
-    sleep(0.1)
-
-    empty_event_queue(camera)
-    print("Capturing blue")
-    path = camera.capture(gp.GP_CAPTURE_IMAGE)
-    print("Captured")
-    camera_file = camera.file_get(path.folder, path.name, gp.GP_FILE_TYPE_NORMAL)
-    camera_file.save('blue.ARW')
-    sleep(0.2)
-    camera.file_delete(path.folder, path.name)
-
-
-
-    rawfile = rawpy.imread('blue.ARW')
-
-    bayer_pattern = rawfile.raw_pattern.astype(np.uint8)
-    bayer_data = rawfile.raw_image.astype('uint16')
-
-    #This is the last image, pull all of the other metadata we need for our DNG
-    WB_AsShot = rawfile.camera_whitebalance
-    WhiteLevel = rawfile.white_level
-    WhiteLevel_perChannel = np.array(rawfile.camera_white_level_per_channel, dtype=np.uint16)
-    BlackLevel_perChannel = np.array(rawfile.black_level_per_channel, dtype=np.uint16)
-    blacklevel_array = np.array(BlackLevel_perChannel)[bayer_pattern].astype(np.uint16)
-    CM_XYZ2camRGB = rawfile.rgb_xyz_matrix
-
-    iBrow,  iBclmn  = np.argwhere(bayer_pattern == 2)[0]
-
-    B  = bayer_data[ iBrow::2,  iBclmn::2]
-
-    print("Blue max:" + str(np.amax(B)))
-    print("Blue min:" + str(np.amin(B)))
-
-    #Create our merged DNG from our three captures
-    bayer_data[ iBrow::2,  iBclmn::2] = B
-    bayer_data[iG0row::2, iG0clmn::2] = G
-    bayer_data[iG1row::2, iG1clmn::2] = G1
-    bayer_data[ iRrow::2,  iRclmn::2] = R
-
-    #Massive amount of copypasta from libraw2dng in my pyimageconvert repo
-    #FIXME: Rework it all to reuse this boilerplate properly
-    preserved_keys = ['Exif.Photo.LensModel',
-                'Exif.Photo.LensModel',
-                'Exif.Photo.FocalLengthIn35mmFilm',
-                'Exif.Photo.FocalLength',
-                'Exif.Photo.FNumber',
-                'Exif.Photo.ExposureTime',
-                'Exif.Image.Make',
-                'Exif.Image.Model',
-                'Exif.Image.Orientation',
-                'Exif.Image.DateTime',
-                'Exif.Sony2.SonyModelID', #not sure if we want to keep this?
-                'Exif.Sony2.LensID', #needed for RT to get lens data
-                'Exif.Photo.ISOSpeedRatings']
-    
-    with pyexiv2.Image('blue.ARW') as exiv_file:
-        exif_data = exiv_file.read_exif()
-        preserved_data = {k: exif_data[k] for k in set(preserved_keys).intersection(exif_data.keys())}
-
-    """     
-        for i in range(blacklevel_array.shape[0]):
-            for j in range(blacklevel_array.shape[1]):
-                bayer_data[i::blacklevel_array.shape[0], j::blacklevel_array.shape[1]] -= blacklevel_array[i][j]
-
-        avg_blacklevel = np.mean(BlackLevel_perChannel)
-        wpoint = 65504 #Largest value representable in a float16
-        bayer_data *= wpoint/(WhiteLevel - avg_blacklevel)
-
-        if(np.amax(bayer_data) > 65504):
-            scalefac = 65504/np.amax(bayer_data)
-            bayer_data *= scalefac
-            wpoint *= scalefac
-    """
-    #RT crashes badly if we preserve G1 as 3 instead of mapping it to 1.  TODO:  Check what DNG spec says about this.
-    bayer_pattern[bayer_pattern == 3] = 1
-
-    #FIXME:  Handle this better/more flexibly/more cleanly
-    #FIXME:  The camera color metadata is meaningless for an RGB capture like this, figure out an appropriate cmatrix.  Fixing that likely fixes the prior FIXME
-    cmatrix = CM_XYZ2camRGB[:-1,:]
-
-    unique_cam_model = preserved_data['Exif.Image.Make'] + " " + preserved_data['Exif.Image.Model']
-
-    dng_extratags = []
-    dng_extratags.append(('CFARepeatPatternDim', 'H', len(bayer_pattern.shape), bayer_pattern.shape, 0))
-    dng_extratags.append(('CFAPattern', 'B', bayer_pattern.size, bayer_pattern.flatten()))
-    dng_extratags.append(('ColorMatrix1', '2i', cmatrix.size, cm_to_flatrational(cmatrix)))
-    dng_extratags.append(('CalibrationIlluminant1', 'H', 1, 21)) #is there an enum for this in tifffile???
-    dng_extratags.append(('BlackLevelRepeatDim', 'H', 2, blacklevel_array.shape)) #BlackLevelRepeatDim
-    dng_extratags.append(('BlackLevel', 'H', blacklevel_array.size, blacklevel_array.flatten().astype(np.uint16))) #We subtracted the black level already
-    dng_extratags.append(('WhiteLevel', 'H', 1, WhiteLevel)) #WhiteLevel, scaled by us to the max for a float64
-    dng_extratags.append(('DNGVersion', 'B', 4, [1,4,0,0])) #DNGVersion
-    dng_extratags.append(('DNGBackwardVersion', 'B', 4, [1,4,0,0])) #DNGBackwardVersion
-    #Since we normalized our channels, our AsShotNeutral is close to 1
-    #FIXME: Derive AsShotNeutral from the maximum of each channel
-    dng_extratags.append(('AsShotNeutral', '2I', 3, np.array([1,1,1,1,1,1], dtype=np.uint32)))
-    dng_extratags.append(('UniqueCameraModel', 's', len(unique_cam_model), unique_cam_model))
-
-    with TIFF.TiffWriter(args['output']) as dng:
-        dng.write(bayer_data.astype(np.uint16),
-                photometric='CFA',
-                compression=None,
-                extratags=dng_extratags,
-                subfiletype=0)
-
-    with pyexiv2.Image(args['output']) as dng:
-        dng.modify_exif(preserved_data)
\ No newline at end of file
+class CaptureSession:
+    '''
+    Holds the camera, the light and the resolved camera config widgets for a whole roll,
+    so that per-frame work is limited to capture, download and merge.
+    backend is the gphoto2 module, or a simulated.Rig to run without a camera.
+    A channel capture that fails is retried up to retries times, reconnecting the camera and the light first.
+    '''
+    def __init__(self, light, shutter_speed, led_settle=0.05, capture_timeout=10.0, ready_timeout=1.0, backend=None,
+                retries=0, retry_delay=2.0):
+        self.gp = backend if backend is not None else load_gphoto2()
+        self.light = light
+        self.shutter_speed = shutter_speed
+        self.led_settle = led_settle
+        self.capture_timeout = capture_timeout
+        self.ready_timeout = ready_timeout
+        #Set once the camera has let ready_timeout pass without a capture complete event, some bodies never send one
+        self.no_complete_event = False
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.camera = None
+        self.cfg = None
+        self.shutterspeed_cfg = None
+        self.speeds = {}
+
+    def __enter__(self):
+        print("Initializing camera")
+        self.camera = self.gp.Camera()
+        self.camera.init()
+        self.configure()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.camera is not None:
+            self.camera.exit()
+
+    def configure(self):
+        print ("Configuring camera")
+        # get configuration tree
+        self.cfg = self.camera.get_config()
+        capturetarget_cfg = self.cfg.get_child_by_name('capturetarget')
+        capturetarget_cfg.set_value('sdram')
+        self.camera.set_config(self.cfg)
+        self.shutterspeed_cfg = self.cfg.get_child_by_name('shutterspeed')
+        self.speeds = {}
+        for j in range(self.shutterspeed_cfg.count_choices()):
+            choice = self.shutterspeed_cfg.get_choice(j)
+            if choice != 'Bulb':
+                self.speeds[Fraction(choice)] = choice
+        self.set_shutter_speed(self.shutter_speed)
+
+    def set_shutter_speed(self, shutter_speed):
+        choice = self.speeds[Fraction(shutter_speed)]
+        if choice == self.shutterspeed_cfg.get_value():
+            return
+        print("Setting shutter speed")
+        self.shutterspeed_cfg.set_value(choice)
+        self.camera.set_config(self.cfg)
+        self.shutter_speed = shutter_speed
+
+    def reconnect(self):
+        with profiler.stage('reconnect'):
+            self.light.reconnect()
+            print("Reconnecting camera")
+            try:
+                self.camera.exit()
+            except Exception as e:
+                print("Closing camera failed: " + str(e))
+            self.camera = self.gp.Camera()
+            self.camera.init()
+            self.configure()
+
+    def capture_channel(self, channel, bright, keep_file=None):
+        #A USB or BLE glitch costs a reconnect and this channel rather than the roll
+        for attempt in range(self.retries + 1):
+            try:
+                if attempt > 0:
+                    sleep(self.retry_delay)
+                    self.reconnect()
+                return self.capture_once(channel, bright, keep_file)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print("Capturing " + channel + " failed: " + str(e) + ", retrying ({}/{})".format(attempt + 1, self.retries))
+
+    def capture_once(self, channel, bright, keep_file=None):
+        print()
+        #Unless running with --no_ack, set_HSI only returns once the light has acknowledged the write, after that it's just LED settling time
+        with profiler.stage('light'):
+            latency = self.light.set_HSI(channel_hues[channel], 100, bright)
+        if latency is not None:
+            log.info("Light set to " + channel + " in %.1f ms", latency*1000)
+            #No latency means the light was already on this color, e.g. repeated shots, so there's nothing to settle
+            with profiler.stage('settle'):
+                sleep(self.led_settle)
+
+        print("Capturing " + channel)
+        start = monotonic()
+        with profiler.stage('shutter'):
+            self.camera.trigger_capture()
+            #Some cameras report capture complete before the file, remember it so we don't wait for it again below
+            complete = False
+            while True:
+                type_, path = wait_for_event(self.gp, self.camera, (self.gp.GP_EVENT_FILE_ADDED, self.gp.GP_EVENT_CAPTURE_COMPLETE),
+                                            self.capture_timeout - (monotonic() - start))
+                if type_ is None:
+                    raise TimeoutError("Camera didn't report a new file within " + str(self.capture_timeout) + "s of triggering " + channel)
+                if type_ == self.gp.GP_EVENT_FILE_ADDED:
+                    break
+                complete = True
+                self.no_complete_event = False
+        log.info("Shutter to file added %.1f ms", (monotonic() - start)*1000)
+        print("Captured")
+
+        start = monotonic()
+        with profiler.stage('transfer'):
+            camera_file = self.camera.file_get(path.folder, path.name, self.gp.GP_FILE_TYPE_NORMAL)
+            #The buffer object keeps camera_file alive, so this doesn't copy the raw out of libgphoto2
+            raw_data = memoryview(camera_file.get_data_and_size())
+        if keep_file is not None:
+            with profiler.stage('keep_raw'):
+                with open(keep_file, 'wb') as f:
+                    f.write(raw_data)
+        with profiler.stage('delete'):
+            self.camera.file_delete(path.folder, path.name)
+        log.info("Downloaded %.1f MB in %.1f ms", raw_data.nbytes/1e6, (monotonic() - start)*1000)
+
+        #Don't trigger the next exposure until the camera says it's done with this one
+        if not complete and not self.no_complete_event:
+            start = monotonic()
+            with profiler.stage('ready'):
+                type_, data = wait_for_event(self.gp, self.camera, (self.gp.GP_EVENT_CAPTURE_COMPLETE,), self.ready_timeout)
+            if type_ is None:
+                print("No capture complete event within {:.0f} ms, not waiting for it from now on".format(self.ready_timeout*1000))
+                self.no_complete_event = True
+            else:
+                log.info("Camera ready after %.1f ms", (monotonic() - start)*1000)
+        return raw_data
+
+    def bracket_speeds(self, stops):
+        #Shutter speeds from the camera's table nearest to the given stops relative to the base shutter speed
+        base = Fraction(self.shutter_speed)
+        speeds = set()
+        for ev in stops:
+            target = math.log2(base) + ev
+            speeds.add(min(self.speeds.keys(), key=lambda speed: abs(math.log2(speed) - target)))
+        return sorted(speeds)
+
+    def capture_stack(self, channel, bright, shots, speeds, calibration=None, keep_root=None):
+        #The light stays on one color while the camera fires repeatedly, each shot is folded in as soon as it's downloaded
+        stack = ChannelStack(channel, bracket=len(speeds) > 1, calibration=calibration)
+        for speed in speeds:
+            self.set_shutter_speed(speed)
+            for shot in range(shots):
+                keep_file = keep_root + '_' + channel + '_{}_{}.ARW'.format(speeds.index(speed), shot) if keep_root else None
+                stack.add(self.capture_channel(channel, bright, keep_file), Fraction(speed))
+        return stack
+
+    def capture_frame_channel(self, channel, bright, output, keep_raw=False, journal=None):
+        keep_file = raw_name(output, channel) if keep_raw else None
+        raw_data = self.capture_channel(channel, bright, keep_file)
+        if journal is not None:
+            journal.spool_channel(output, channel, raw_data, keep_file)
+        return raw_data
+
+    def capture_frame(self, rgb, output, keep_raw=False, journal=None, reuse=None):
+        #reuse is {channel: raw file} for channels an interrupted run already captured
+        reuse = reuse or {}
+        captures = []
+        for channel, bright in zip(channel_hues.keys(), rgb):
+            if channel in reuse:
+                print("Reusing " + channel + " from " + reuse[channel])
+                captures.append(reuse[channel])
+            else:
+                captures.append(self.capture_frame_channel(channel, bright, output, keep_raw, journal))
+        return captures
+
+    def capture_frame_stacks(self, rgb, output, shots, speeds, calibration=None, keep_raw=False):
+        root = os.path.splitext(output)[0] if keep_raw else None
+        return [self.capture_stack(channel, bright, shots, speeds, calibration, root)
+                for channel, bright in zip(channel_hues.keys(), rgb)]
+
+def raw_name(output, channel):
+    #Intermediate files are named after the output so that frames in flight in the pipeline don't collide
+    return os.path.splitext(output)[0] + '_' + channel + '.ARW'
+
+def check_calibration(session, calibration, speeds=None):
+    #The masters are only looked up by the merge, so without this a missing one would only show up after the first frame.
+    #One dark capture gives the camera model and exposure time they're keyed by.
+    exif = read_exif(session.capture_channel('red', 0))
+    for speed in speeds or [exif_exposure_time(exif)]:
+        calibration.load(exif_camera_model(exif), speed, calibration.rgb)
+
+def make_light(addresses, no_ack=False):
+    addresses = addresses or [None]
+    if len(addresses) == 1:
+        return NeewerLight(address=addresses[0], acknowledge=not no_ack)
+    return NeewerLightGroup(addresses, acknowledge=not no_ack)
+
+def profiled(process):
+    #Attributes the merge worker's stages to the frame, which is always the last argument
+    def run(*args):
+        with profiler.frame(args[-1]):
+            return process(*args)
+    return run
+
+def atomic_merge(process, journal=None):
+    #Merges to a temporary name that's renamed over the output once complete, so an interrupted merge never leaves
+    #a truncated DNG behind, and records the outcome in the journal.  The output is always the last argument.
+    def run(*args):
+        output = args[-1]
+        root, ext = os.path.splitext(output)
+        tmp_output = root + '.tmp' + ext
+        try:
+            result = process(*args[:-1], tmp_output)
+            os.replace(tmp_output, output)
+        except Exception as e:
+            if os.path.exists(tmp_output):
+                os.remove(tmp_output)
+            if journal is not None:
+                journal.dng_status(output, 'failed', str(e))
+            raise
+        if journal is not None:
+            journal.dng_status(output, 'written')
+        if result is not None:
+            #Printed for every frame so drift shows up in the capture log
+            print("Registration " + output + ": " + format_shifts(result))
+        return result
+    return run
+
+def submit_frame(pipeline, captures, output, capture_channel, args, journal=None):
+    #With --reshoot, wait for the merge to measure registration and re-capture channels that moved
+    #Time spent here is the capture thread waiting for a merge worker
+    with profiler.stage('queue_wait'):
+        future = pipeline.submit(*captures, output)
+    for attempt in range(args['reshoot']):
+        moved = misregistered(future.result(), args['max_shift'])
+        if len(moved) == 0:
+            break
+        print("Re-shooting " + ", ".join(moved) + " for " + output)
+        #Recorded before anything is re-captured, so a crash before the next merge doesn't leave the misaligned DNG counted as done
+        if journal is not None:
+            journal.dng_status(output, 'stale')
+        for channel in moved:
+            i = list(channel_hues.keys()).index(channel)
+            captures[i] = capture_channel(channel, args['rgb'][i], output)
+        future = pipeline.submit(*captures, output)
+
+    def warn(future):
+        profiler.memory(output)
+        if journal is not None:
+            #Runs on the merge worker, so a spool slower than the merge holds up the pipeline rather than filling RAM
+            journal.wait_spooled(output)
+        if future.exception() is None and journal is not None and not args['keep_raw']:
+            #The channels were only spooled for --resume
+            for raw_file in journal.raw_files(output):
+                if os.path.exists(raw_file):
+                    os.remove(raw_file)
+        if future.exception() is None and future.result() is not None:
+            moved = misregistered(future.result(), args['max_shift'])
+            if moved:
+                print("WARNING: " + ", ".join(moved) + " moved more than " + str(args['max_shift']) + " px in " + output)
+    future.add_done_callback(warn)
+    return future
+
+def roll_output_name(output, frame):
+    if '{' in output:
+        return output.format(frame)
+    root, ext = os.path.splitext(output)
+    return root + '_{:03d}'.format(frame) + ext
+
+def wait_for_advance(args, frame):
+    if args['advance'] == 'timer':
+        sleep(args['interval'])
+        return True
+    response = input("Advance film to frame " + str(frame) + " and press Enter (q to finish roll): ")
+    return response.strip().lower() != 'q'
+
+def main():
+    logging.basicConfig(
+        format='%(levelname)s: %(name)s: %(message)s', level=logging.ERROR)
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-o', '--output', required=True,
+        help='path to output DNG.  In roll mode, a format string such as scan_{:03d}.dng, otherwise the frame number is appended')
+    ap.add_argument('-s', '--shutter_speed', required=True,
+                    help='Shutter Speed')
+    ap.add_argument('-r', '--rgb', required=True, nargs=3, type=int,
+                    help='RGB intensities for Neewer light, 0-100')
+    ap.add_argument('-a', '--address', required=False, type=str, nargs='+',
+                    help='BLE address of Neewer light (default: the last light used, or the first one found).  Give several addresses to drive several lights at once')
+    ap.add_argument('--no_ack', action='store_true',
+                    help="Don't wait for the light to acknowledge commands.  Faster, but --led_settle then has to cover the BLE latency too")
+    ap.add_argument('--light_timeout', type=float, default=10.0,
+                    help='Seconds to scan for the Neewer light before giving up.  Only a light paired with this computer is connected to without a scan')
+    ap.add_argument('--roll', action='store_true',
+                    help='Keep the camera and light open and capture frame after frame')
+    ap.add_argument('--frames', type=int, default=None,
+                    help='Number of frames to capture in roll mode (default: until q is entered)')
+    ap.add_argument('--start', type=int, default=1,
+                    help='Number of the first frame in roll mode')
+    ap.add_argument('--advance', choices=['key', 'timer'], default='key',
+                    help='Advance to the next frame on Enter, or after a fixed interval (e.g. for a motorized film advancer)')
+    ap.add_argument('--interval', type=float, default=2.0,
+                    help='Seconds to wait between frames with --advance timer')
+    ap.add_argument('--workers', type=int, default=2,
+                    help='Number of worker threads decoding, merging and writing DNGs while the next frame is exposed')
+    ap.add_argument('--queue_depth', type=int, default=2,
+                    help='Maximum number of captured frames waiting for a merge worker before capture blocks')
+    ap.add_argument('--keep_raw', action='store_true',
+                    help='Also save each channel capture as <output>_red/green/blue.ARW for debugging')
+    ap.add_argument('--led_settle', type=float, default=0.05,
+                    help='Seconds to wait for the LEDs to settle after the light acknowledges a color change')
+    ap.add_argument('--capture_timeout', type=float, default=10.0,
+                    help='Seconds to wait for the camera to report the captured file')
+    ap.add_argument('--ready_timeout', type=float, default=1.0,
+                    help="Seconds to wait for the camera to report capture complete before the next exposure.  If it doesn't, it isn't waited for again")
+    ap.add_argument('-v', '--verbose', action='store_true',
+                    help='Log light, shutter and transfer latencies')
+    ap.add_argument('--compression', choices=compression_modes.keys(), default='none',
+                    help='Lossless DNG compression.  ljpeg is what cameras use, deflate is not readable by LibRaw/RawTherapee')
+    ap.add_argument('--tile_size', type=int, default=256,
+                    help='Tile size for compressed DNGs, tiles are compressed in parallel (multiple of 16)')
+    ap.add_argument('--tiled', action='store_true',
+                    help='Merge band by band into a memory-mapped DNG to bound memory use on very large frames (uncompressed only)')
+    ap.add_argument('--band_rows', type=int, default=256,
+                    help='Rows per band with --tiled')
+    ap.add_argument('--flat_field', action='store_true',
+                    help='Apply the master dark and flat frames recorded by calibrate.py for this camera, shutter speed and RGB intensities')
+    ap.add_argument('--calibration_dir', default=default_calibration_dir,
+                    help='Directory holding master calibration frames')
+
+    ap.add_argument('--shots', type=int, default=1,
+                    help='Exposures averaged per channel (per shutter speed when bracketing), written as a 16-bit DNG')
+    ap.add_argument('--bracket', type=float, nargs='+', default=None,
+                    help='Also expose each channel at these stops relative to --shutter_speed (e.g. 0 2) and merge to a 16-bit DNG referenced to the shortest exposure')
+
+    ap.add_argument('--register', action='store_true',
+                    help='Measure the shift of the red and blue captures relative to green for every frame and warn if it exceeds --max_shift')
+    ap.add_argument('--max_shift', type=float, default=1.0,
+                    help='Largest acceptable shift between channels, in pixels')
+    ap.add_argument('--reshoot', type=int, default=0,
+                    help='Re-capture channels that moved more than --max_shift up to this many times (implies --register, waits for each merge)')
+
+    ap.add_argument('--profile', default=None,
+                    help='Write per-stage timings and per-frame peak memory to this JSON lines file, and print a p50/p95 summary at the end')
+
+    ap.add_argument('--auto_exposure', action='store_true',
+                    help='Meter the film base once per color at the start of the roll and solve for the shutter speed and RGB intensities (see auto_exposure.py), -s and -r are the metering starting point')
+    ap.add_argument('--meter_roi', type=float, nargs=4, default=None,
+                    help='Area to meter with --auto_exposure as fractions of the frame: left top right bottom')
+    ap.add_argument('--rig', default='default',
+                    help='Name of the light response curve to use with --auto_exposure')
+    ap.add_argument('--simulate', action='store_true',
+                    help='Use a simulated camera and light (see simulated.py) instead of real hardware')
+    ap.add_argument('--simulate_faults', type=float, default=0.0,
+                    help='With --simulate, fraction of camera and light commands that fail, to exercise --retries and --resume')
+
+    ap.add_argument('--retries', type=int, default=3,
+                    help='Times to reconnect the camera and light and retry a channel capture that failed')
+    ap.add_argument('--retry_delay', type=float, default=2.0,
+                    help='Seconds to wait before reconnecting after a failed capture')
+    ap.add_argument('--journal', default=None,
+                    help='Roll journal recording captured channels and written DNGs (default: capture_journal.jsonl next to the output)')
+    ap.add_argument('--no_journal', action='store_true',
+                    help="Don't keep a roll journal")
+    ap.add_argument('--spool_dir', default=None,
+                    help="Save each channel capture to this directory until its frame's DNG is written, so --resume can reuse the channels of an interrupted frame.  "
+                         "That's 25-60 MB written and hashed per channel, off the capture thread but competing with the DNG writes, so use a local disk rather than the output's.  "
+                         "Without it (or --keep_raw) --resume re-captures an interrupted frame from the start")
+    ap.add_argument('--resume', action='store_true',
+                    help='Continue an interrupted roll: skip frames whose DNG was written and reuse channels already captured for the others')
+
+    args = vars(ap.parse_args())
+
+    if args['simulate']:
+        from simulated import Rig
+        backend = Rig(fault_rate=args['simulate_faults'])
+    else:
+        backend = load_gphoto2()
+        if backend is None:
+            ap.error('gphoto2 is not installed, only --simulate is available')
+    callback_obj = backend.check_result(backend.use_python_logging())
+
+    if args['verbose']:
+        log.setLevel(logging.INFO)
+
+    if args['roll'] and args['advance'] == 'timer' and args['frames'] is None:
+        ap.error('--advance timer requires --frames')
+    if args['tiled'] and args['compression'] != 'none':
+        ap.error('--tiled only supports uncompressed DNGs')
+    stacked = args['shots'] > 1 or args['bracket'] is not None
+    if stacked and args['tiled']:
+        ap.error('--tiled does not support --shots or --bracket')
+    if args['resume'] and (not args['roll'] or args['no_journal']):
+        ap.error('--resume requires --roll and a journal')
+    if args['spool_dir'] and (not args['roll'] or args['no_journal']):
+        ap.error('--spool_dir requires --roll and a journal')
+
+    register = args['register'] or args['reshoot'] > 0
+    if args['profile'] is not None:
+        profiler.enable(args['profile'])
+
+    calibration = CalibrationStore(args['calibration_dir'], args['rgb']) if args['flat_field'] else None
+
+    journal = None
+    if args['roll'] and not args['no_journal']:
+        journal_file = args['journal'] or os.path.join(os.path.dirname(os.path.abspath(args['output'])), 'capture_journal.jsonl')
+        journal = RollJournal(journal_file, args['spool_dir'])
+        print("Journaling to " + journal_file)
+
+    if args['simulate']:
+        light = backend.light(acknowledge=not args['no_ack'])
+    else:
+        light = make_light(args['address'], args['no_ack'])
+    with light:
+        with CaptureSession(light, args['shutter_speed'], args['led_settle'],
+                            args['capture_timeout'], args['ready_timeout'], backend,
+                            args['retries'], args['retry_delay']) as session:
+            print("Discovering Neewer light")
+            light.find_device(args['light_timeout'])
+            if(light.neewer_device is None):
+                exit(1)
+
+            print("Neewer light found")
+
+            if args['auto_exposure']:
+                from auto_exposure import LedResponse, auto_expose, default_model_file
+                shutter_speed, rgb = auto_expose(session, args['rgb'], args['meter_roi'],
+                                                LedResponse.load(default_model_file, args['rig']))
+                session.set_shutter_speed(shutter_speed)
+                args['shutter_speed'], args['rgb'] = shutter_speed, rgb
+                if calibration is not None:
+                    calibration.rgb = rgb
+                print("Auto exposure: -s " + shutter_speed + " -r " + " ".join(str(b) for b in rgb))
+
+            if stacked:
+                #Calibration is applied to each shot as it's stacked, before the merge
+                speeds = session.bracket_speeds([0] + (args['bracket'] or []))
+                print("Shutter speeds: " + ", ".join(session.speeds[speed] for speed in speeds))
+                merge = partial(merge_stacks, compression=args['compression'], tile_size=args['tile_size'], register=register)
+                capture_frame = lambda output: session.capture_frame_stacks(args['rgb'], output, args['shots'], speeds,
+                                                                            calibration, args['keep_raw'])
+                capture_channel = lambda channel, bright, output: session.capture_stack(channel, bright, args['shots'], speeds, calibration,
+                                                                            os.path.splitext(output)[0] if args['keep_raw'] else None)
+            else:
+                merge = partial(merge_channels, compression=args['compression'], tile_size=args['tile_size'],
+                                tiled=args['tiled'], band_rows=args['band_rows'], calibration=calibration, register=register)
+                capture_frame = lambda output: session.capture_frame(args['rgb'], output, args['keep_raw'], journal,
+                                                                    journal.reusable_channels(output) if args['resume'] else None)
+                capture_channel = lambda channel, bright, output: session.capture_frame_channel(channel, bright, output,
+                                                                            args['keep_raw'], journal)
+            if calibration is not None:
+                try:
+                    check_calibration(session, calibration, speeds if stacked else None)
+                except FileNotFoundError as e:
+                    print(e)
+                    exit(1)
+            with FramePipeline(profiled(atomic_merge(merge, journal)), workers=args['workers'], depth=args['queue_depth']) as pipeline:
+                if not args['roll']:
+                    output = args['output']
+                    with profiler.frame(output):
+                        submit_frame(pipeline, capture_frame(output), output, capture_channel, args)
+                else:
+                    frame = args['start']
+                    first = True
+                    try:
+                        while args['frames'] is None or frame < args['start'] + args['frames']:
+                            output = roll_output_name(args['output'], frame)
+                            if args['resume'] and journal.done(output):
+                                print("Frame " + str(frame) + " already written to " + output)
+                                frame += 1
+                                continue
+                            if not first and not wait_for_advance(args, frame):
+                                break
+                            first = False
+                            print("\nFrame " + str(frame) + " -> " + output)
+                            #A resumed frame keeps the channels it already has
+                            if journal is not None and not (args['resume'] and output in journal.frames):
+                                journal.frame_started(frame, output)
+                            with profiler.frame(output):
+                                submit_frame(pipeline, capture_frame(output), output, capture_channel, args, journal)
+                            frame += 1
+                    except (Exception, KeyboardInterrupt):
+                        if journal is not None:
+                            print("\nRoll interrupted at frame " + str(frame) + ", run again with --resume to continue")
+                        raise
+
+            if args['verbose'] and light.latencies:
+                print("\nLight command latency:")
+                print(format_latency_histogram(light.latencies))
+
+            if args['profile'] is not None:
+                print("\nStage timings:")
+                print(profiler.summary())
+                profiler.close()
+
+    if journal is not None:
+        journal.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,214 +1,196 @@
 #!/usr/bin/env python3
 
 '''
-Converts a CSV file exported by WebPlotDigitizer ( https://apps.automeris.io/wpd/ ) to a dcamprof camera SSF JSON
+Fits the film characteristic curve model in film_model.py to a density CSV exported by WebPlotDigitizer ( https://apps.automeris.io/wpd/ )
+and plots the fit.
 For the time being, the column headers need fixing - Replace the empty entry to the right of Blue in the first row with Blue, etc.
 '''
 import argparse
+import hashlib
+import json
+import os
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
-from functools import partial
-from matplotlib.widgets import MultiCursor
+from film_model import filmdata, tcoeff_to_scenelin
+from wpd_csv import interp_extrapolate, read_wpd_csv
+
+#Fitted profiles, keyed by a hash of the CSV and the fit bounds, so refitting an unchanged film is instant
+default_fit_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'rgb_led_filmscan', 'density_fits')
+#Bump when the fit changes, so stale cached results aren't used
+fit_version = 1
+
+density_samples = 1000
+
+def scene_curves(data):
+    '''
+    Inverts each channel's density vs. log exposure curve to log exposure vs. density, resampled onto a common
+    grid of density_samples densities from 0 to the highest density of any channel.
+    '''
+    columns = read_wpd_csv(data)
+    curves = {}
+    for color, c in zip(['Red', 'Green', 'Blue'], 'rgb'):
+        exposure, density = columns[color]
+        # For now, handle Kodak Gold being nonmonotonic in blue by forcing it to be monotonic, since there's no sane way to invert such a curve
+        density = np.flip(np.minimum.accumulate(np.flip(density)))
+        density = density - density.min()
+        #Forcing monotonicity leaves runs of equal densities, use the mean exposure of each run
+        density, run = np.unique(density, return_inverse=True)
+        curves[c] = (density, np.bincount(run, weights=exposure)/np.bincount(run))
+
+    density_vals = np.linspace(0, max(curves[c][0][-1] for c in 'rgb'), density_samples)
+    return density_vals, {c: interp_extrapolate(density_vals, *curves[c]) for c in 'rgb'}
 
-ap = argparse.ArgumentParser()
-ap.add_argument('-i', '--input', type=argparse.FileType('rb'), required=True,
-    help='path to input files')
-ap.add_argument('--dmax', type=float, default=1.5,
-    help='maximum density for exponent fitting')
-ap.add_argument('--dmin', type=float, default=0.5,
-    help='minimum density for exponent fitting')
-ap.add_argument('-n', '--name', default='Model Fit to Data',
-    help='Name of the film for the graph')
-
-args = vars(ap.parse_args())
-
-pd.options.mode.copy_on_write = True
-
-density_data = pd.read_csv(args['input'], header=[0,1])
-
-'''
-WebPlotDigitizer exports in the order you added points, and has individual X values for each dataset instead of a single X column that is suitable for indexing,
-so let's do some re-sorting.
 '''
-datasets = {}
-for color in ['Red', 'Green', 'Blue']:
-    cdata = density_data[color]
-    cdata.rename(columns={'Y' : color}, inplace=True)
-    cdata.set_index('X', inplace=True, drop=True)
-    cdata = cdata[cdata.index.notnull()]
-    cdata.sort_index(inplace=True)
-    # For now, handle Kodak Gold being nonmonotonic in blue by forcing it to be monotonic, since there's no sane way to invert such a curve
-    cdata[color] = np.flip(np.minimum.accumulate(np.flip(cdata[color])))
-    datasets[color] = cdata
-
-density_data = pd.concat(datasets.values()).sort_index()
-
-# https://stackoverflow.com/questions/35855772/pandas-merge-duplicate-index-into-single-index
-density_data = density_data.groupby(density_data.index).sum(min_count=1)
-
-
-density_data.rename(columns={'Red' : 'r', 'Green' : 'g', 'Blue' : 'b'}, inplace=True)
-
-density_data.r -= density_data.r.min()
-density_data.g -= density_data.g.min()
-density_data.b -= density_data.b.min()
-
-# https://stackoverflow.com/questions/43781465/how-to-swap-index-and-values-on-pandas-dataframe
-scene_data = density_data.stack().reset_index()
-scene_data.columns = ['i', 'c', 'd']
-
-scene_data = scene_data.pivot_table(index='d', columns='c', values='i')
-
-# https://stackoverflow.com/questions/41493282/in-python-pandas-how-can-i-re-sample-and-interpolate-a-dataframe
-istep = 0.1
-exposure_vals = np.arange(-3.62,1.0 + istep, istep)
-density_data = density_data.reindex(density_data.index.union(exposure_vals))
-
-dstep = 0.01
-density_vals = np.linspace(0, density_data.max().max(), 1000)
-scene_data = scene_data.reindex(scene_data.index.union(density_vals))
-
-#TODO:  Determine if we need to bother with extrapolation and interpolation since we're just curve-fitting.  May cause more problems than it solves in this application.  The dangers of copypasta!
-# https://stackoverflow.com/questions/68548971/linearly-extrapolate-pandas-dataframe-using-built-in-interpolate-method
-density_data.interpolate(method='slinear', fill_value="extrapolate", limit_direction="both", inplace=True)
-density_data = density_data.loc[exposure_vals]
-
-scene_data.interpolate(method='slinear', fill_value="extrapolate", limit_direction="both", inplace=True)
-scene_data = scene_data.loc[density_vals]
-
-
-def tcoeff_to_scenelin(tcoeff, reflevel, exp, linadj, strexp):
-    scenelin = np.power(tcoeff, -exp)*reflevel
-    return np.power((np.power(scenelin,strexp)-linadj), 1.0/strexp)
+Stage 1, the simple exponent model log10(scene) = log10(inref) + exp*density, is linear in log10(inref) and the
+per-channel exponents, so it's solved directly as a bounded linear least squares problem over all three channels.
 
+Stage 2 fits each channel's curve strength with the other parameters fixed.  The channels don't interact,
+so the residuals of all three are evaluated in one go and the Jacobian is diagonal per channel.
 '''
-curve_fit doesn't support fitting three datasets with one common variable and one independent variable
-but it doesn't care about the order of your data
-
-So repeat the X data 3 times, and concatenate the Y data for R, G, and B.
-
-Similarly concatenate our fit function's results the same way
-'''
-
-def fitfunc1(tcoeff, reflevel ,rexp, gexp, bexp):
-    tcoeff = tcoeff.reshape(-1,3)
-    return np.concatenate((np.log10(tcoeff_to_scenelin(tcoeff[:,0], reflevel, rexp, 0, 1)).flatten(),
-                        np.log10(tcoeff_to_scenelin(tcoeff[:,1], reflevel, gexp, 0, 1)).flatten(),
-                        np.log10(tcoeff_to_scenelin(tcoeff[:,2], reflevel, bexp, 0, 1)).flatten()))
-
-
-fit_df = scene_data.loc[(args['dmin'] <= scene_data.index) & (scene_data.index <= args['dmax'])]
-
-fit_tcoeff = np.repeat(np.power(10,-fit_df.index),3).to_numpy()
-fit_data = np.concatenate((fit_df.r , fit_df.g , fit_df.b))
-
-p0 = [1.0, 1.5, 1.5, 1.5]
-(soln, cov) = curve_fit(fitfunc1, fit_tcoeff, fit_data, p0, bounds=((-np.inf,0, 0, 0), (np.inf,5.0,5.0,5.0)))
-scenemin = np.mean(scene_data.iloc[0])*np.log2(10)
-evdelt = np.log2(soln[0])-scenemin
-
-def fitfunc2(tcoeff, curvr, curvg, curvb, evdelt, reflevel ,rexp, gexp, bexp):
-    tcoeff = tcoeff.reshape(-1,3)
-    linadjr = np.power(reflevel,curvr) - np.power(reflevel*np.power(2,-evdelt),curvr)
-    linadjg = np.power(reflevel,curvg) - np.power(reflevel*np.power(2,-evdelt),curvg)
-    linadjb = np.power(reflevel,curvb) - np.power(reflevel*np.power(2,-evdelt),curvb)
-    return np.concatenate((np.log10(tcoeff_to_scenelin(tcoeff[:,0], reflevel, rexp, linadjr, curvr)).flatten(),
-                        np.log10(tcoeff_to_scenelin(tcoeff[:,1], reflevel, gexp, linadjg, curvg)).flatten(),
-                        np.log10(tcoeff_to_scenelin(tcoeff[:,2], reflevel, bexp, linadjb, curvb)).flatten()))
-
-fit_df = scene_data.loc[(0.0 <= scene_data.index) & (scene_data.index <= args['dmax'])]
-
-fit_tcoeff = np.repeat(np.power(10,-fit_df.index),3).to_numpy()
-fit_data = np.concatenate((fit_df.r , fit_df.g , fit_df.b))
-
-p0 = [1.0, 1.0, 1.0]
-(soln2, cov) = curve_fit(partial(fitfunc2, evdelt = evdelt, reflevel = soln[0], rexp = soln[1], gexp = soln[2], bexp = soln[3]), fit_tcoeff, fit_data, p0, bounds=((0, 0, 0), (5.0,5.0,5.0)))
-
-""" 
-def equations(evadj, outref, strexp):
-    print()
-    print(evadj)
-    linadj = np.power(2.0,-evadj)
-    print(np.log2(outref))
-    #Exp doesn't matter below since we're passing a tcoeff of 1, so just hardcode to -1.5, better than rewriting the function a second time
-    res = np.abs(np.log2(tcoeff_to_scenelin(1.0, 1.5, linadj, strexp)) - np.log2(outref))
-    print(res)
-    return res
-
-min_evadj = -np.log2(np.power(1.0/np.power(10,2.8),strexp))
-bounds = [min_evadj,40]
-soln = minimize_scalar(equations, bounds=bounds, args=(np.power(10,-3.62), strexp))
-print(soln)
-"""
-
-filmdata =  {'Fuji Superia X-Tra 400':   {'inref' : np.power(2.0,-9.3014),
-                                        'evdelt' : 2.724,
-                                        'exp' : {'r' : 1.6,
-                                                'g' : 1.48,
-                                                'b' : 1.45},
-                                        'cstr': {'r' : 1.5,
-                                                'g' : 2.0,
-                                                'b' : 2.6}
-                                        },
-            'Kodak Gold 200':   {'inref' : np.power(2.0,-7.95),
-                                        'evdelt' : 4.0,
-                                        'exp' : {'r' : 1.83,
-                                                'g' : 1.72,
-                                                'b' : 1.65},
-                                        'cstr': {'r' : 2.0,
-                                                'g' : 1.8,
-                                                'b' : 3.0}
-                                        },
-            args['name']:   {'inref' : soln[0],
-                                        'evdelt' : evdelt,
-                                        'exp' : {'r' : soln[1],
-                                                'g' : soln[2],
-                                                'b' : soln[3]},
-                                        'cstr': {'r' : soln2[0],
-                                                'g' : soln2[1],
-                                                'b' : soln2[2]}
-                                        }
-            }
-
-tcoeff_vals = np.power(10,-(density_vals))
-
-film = args['name']
-inref = filmdata[film]['inref']
-evdelt = filmdata[film]['evdelt']
-outref = inref*np.power(2.0,-evdelt)
-plotnum = 0
-pltn = None
-
-print("RawTherapee exponent settings:")
-print("Reference power: " + str(filmdata[film]['exp']['g']))
-print("Red ratio: " + str(filmdata[film]['exp']['r']/filmdata[film]['exp']['g']))
-print("Blue ratio:" + str(filmdata[film]['exp']['b']/filmdata[film]['exp']['g']))
-fig, axs = plt.subplots(2,2, sharex=True, sharey=True)
-axs[-1,-1].axis('off')
-fig.suptitle('Scene Light vs. Film Transmission Coefficient for ' + film)
-for color in ['r', 'g', 'b']:
-    exp = filmdata[film]['exp'][color]
-    cstr = filmdata[film]['cstr'][color]
-    linadj = np.power(inref,cstr) - np.power(outref,cstr)
-    pltn = axs[plotnum % 2, plotnum // 2]
-    plotnum += 1
-
-    pltn.xaxis.set_tick_params(labelbottom=True)
-    pltn.yaxis.set_tick_params(labelbottom=True)
-    pltn.plot(scene_data.index, np.log2(np.power(10,scene_data[color])), color=color, alpha=0.5, label='Film Response')
-    pltn.plot(density_vals, np.log2(tcoeff_to_scenelin(tcoeff_vals, inref, exp, 0.0, 1.0)), color=color, dashes=[1,3], label='Simple Exponent (exp = -{:.2f})'.format(exp))
-    pltn.plot(density_vals, np.log2(tcoeff_to_scenelin(tcoeff_vals, inref, exp, linadj, cstr)), color=color, dashes=[2,1], label='Enhanced Model (exp = -{:.2f}, str={:.2f})'.format(exp,cstr))
-    pltn.axvline(x=args['dmin'], alpha=0.5)
-    pltn.axvline(x=args['dmax'], alpha=0.5)
-    pltn.set_xlabel('Density difference from Dmin')
-    pltn.set_ylabel('Scene Light (EV)')
-    pltn.grid()
-    pltn.legend()
-
-# https://stackoverflow.com/questions/63195460/how-to-have-a-fast-crosshair-mouse-cursor-for-subplots-in-matplotlib
-cursor = MultiCursor(fig.canvas, (axs[0,0], axs[0,1], axs[1,0]), color='r', lw=0.5, horizOn=True, vertOn=True)
-
-plt.show()
-
+def fit_exponents(density_vals, scene, dmin, dmax):
+    #scipy and matplotlib are only imported where they're used, they take over a second to import
+    from scipy.optimize import lsq_linear
+    d = density_vals[(dmin <= density_vals) & (density_vals <= dmax)]
+    n = d.size
+    A = np.zeros((3*n, 4))
+    A[:, 0] = 1.0
+    for i, c in enumerate('rgb'):
+        A[i*n:(i + 1)*n, i + 1] = d
+    y = np.concatenate([scene[c][(dmin <= density_vals) & (density_vals <= dmax)] for c in 'rgb'])
+    soln = lsq_linear(A, y, bounds=([-np.inf, 0, 0, 0], [np.inf, 5.0, 5.0, 5.0])).x
+    return np.power(10.0, soln[0]), soln[1:]
+
+def fit_strengths(density_vals, scene, dmax, inref, evdelt, exps):
+    from scipy.optimize import least_squares
+    mask = (0.0 <= density_vals) & (density_vals <= dmax)
+    d = density_vals[mask]
+    y = np.stack([scene[c][mask] for c in 'rgb'])
+    #Natural logs of the simple model's scene light, inref and outref
+    ln_s = np.log(inref) + np.log(10.0)*np.outer(exps, d)
+    ln_in = np.log(inref)
+    ln_out = ln_in - evdelt*np.log(2.0)
+
+    def model(cstr):
+        c = cstr[:, None]
+        u = np.exp(c*ln_s) - np.exp(c*ln_in) + np.exp(c*ln_out)
+        return c, u
+
+    def residuals(cstr):
+        c, u = model(cstr)
+        return (np.log(u)/(c*np.log(10.0)) - y).ravel()
+
+    def jacobian(cstr):
+        c, u = model(cstr)
+        du = ln_s*np.exp(c*ln_s) - ln_in*np.exp(c*ln_in) + ln_out*np.exp(c*ln_out)
+        dr = (du/(u*c) - np.log(u)/(c*c))/np.log(10.0)
+        jac = np.zeros((3*d.size, 3))
+        for i in range(3):
+            jac[i*d.size:(i + 1)*d.size, i] = dr[i]
+        return jac
+
+    return least_squares(residuals, np.ones(3), jac=jacobian, bounds=(0, 5.0)).x
+
+def fit_profile(density_vals, scene, dmin, dmax):
+    inref, exps = fit_exponents(density_vals, scene, dmin, dmax)
+    scenemin = np.mean([scene[c][0] for c in 'rgb'])*np.log2(10)
+    evdelt = np.log2(inref) - scenemin
+    cstr = fit_strengths(density_vals, scene, dmax, inref, evdelt, exps)
+    return {'inref': float(inref),
+            'evdelt': float(evdelt),
+            'exp': dict(zip('rgb', exps.tolist())),
+            'cstr': dict(zip('rgb', cstr.tolist()))}
+
+def fit_cache_key(data, dmin, dmax):
+    key = hashlib.sha256(data)
+    key.update('{}:{!r}:{!r}'.format(fit_version, float(dmin), float(dmax)).encode())
+    return key.hexdigest()
+
+def cached_fit(data, dmin, dmax, cache_dir=default_fit_cache_dir, curves=None):
+    #Returns the fitted profile, from the cache if this CSV was already fitted with the same bounds
+    cache_file = os.path.join(cache_dir, fit_cache_key(data, dmin, dmax) + '.json') if cache_dir else None
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            return json.load(f)
+    density_vals, scene = curves or scene_curves(data)
+    profile = fit_profile(density_vals, scene, dmin, dmax)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        #Unique per process, since build_film_profiles.py may fit the same CSV in several processes
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(profile, f)
+        os.replace(tmp_file, cache_file)
+    return profile
+
+def plot_fit(film, profile, density_vals, scene, dmin, dmax):
+    import matplotlib.pyplot as plt
+    tcoeff_vals = np.power(10,-(density_vals))
+
+    inref = profile['inref']
+    evdelt = profile['evdelt']
+    outref = inref*np.power(2.0,-evdelt)
+    plotnum = 0
+    pltn = None
+
+    fig, axs = plt.subplots(2,2, sharex=True, sharey=True)
+    axs[-1,-1].axis('off')
+    fig.suptitle('Scene Light vs. Film Transmission Coefficient for ' + film)
+    for color in ['r', 'g', 'b']:
+        exp = profile['exp'][color]
+        cstr = profile['cstr'][color]
+        linadj = np.power(inref,cstr) - np.power(outref,cstr)
+        pltn = axs[plotnum % 2, plotnum // 2]
+        plotnum += 1
+
+        pltn.xaxis.set_tick_params(labelbottom=True)
+        pltn.yaxis.set_tick_params(labelbottom=True)
+        pltn.plot(density_vals, np.log2(np.power(10,scene[color])), color=color, alpha=0.5, label='Film Response')
+        pltn.plot(density_vals, np.log2(tcoeff_to_scenelin(tcoeff_vals, inref, exp, 0.0, 1.0)), color=color, dashes=[1,3], label='Simple Exponent (exp = -{:.2f})'.format(exp))
+        pltn.plot(density_vals, np.log2(tcoeff_to_scenelin(tcoeff_vals, inref, exp, linadj, cstr)), color=color, dashes=[2,1], label='Enhanced Model (exp = -{:.2f}, str={:.2f})'.format(exp,cstr))
+        pltn.axvline(x=dmin, alpha=0.5)
+        pltn.axvline(x=dmax, alpha=0.5)
+        pltn.set_xlabel('Density difference from Dmin')
+        pltn.set_ylabel('Scene Light (EV)')
+        pltn.grid()
+        pltn.legend()
+    return fig, axs
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input', type=argparse.FileType('rb'), required=True,
+        help='path to input files')
+    ap.add_argument('--dmax', type=float, default=1.5,
+        help='maximum density for exponent fitting')
+    ap.add_argument('--dmin', type=float, default=0.5,
+        help='minimum density for exponent fitting')
+    ap.add_argument('-n', '--name', default='Model Fit to Data',
+        help='Name of the film for the graph')
+    ap.add_argument('--cache_dir', default=default_fit_cache_dir,
+        help='Directory caching fit results')
+    ap.add_argument('--no_cache', action='store_true',
+        help='Always refit')
+
+    args = vars(ap.parse_args())
+
+    data = args['input'].read()
+    curves = scene_curves(data)
+    profile = cached_fit(data, args['dmin'], args['dmax'], None if args['no_cache'] else args['cache_dir'], curves)
+
+    film = args['name']
+    filmdata[film] = profile
+
+    print("RawTherapee exponent settings:")
+    print("Reference power: " + str(filmdata[film]['exp']['g']))
+    print("Red ratio: " + str(filmdata[film]['exp']['r']/filmdata[film]['exp']['g']))
+    print("Blue ratio:" + str(filmdata[film]['exp']['b']/filmdata[film]['exp']['g']))
+
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import MultiCursor
+    fig, axs = plot_fit(film, profile, *curves, args['dmin'], args['dmax'])
+
+    # https://stackoverflow.com/questions/63195460/how-to-have-a-fast-crosshair-mouse-cursor-for-subplots-in-matplotlib
+    cursor = MultiCursor(fig.canvas, (axs[0,0], axs[0,1], axs[1,0]), color='r', lw=0.5, horizOn=True, vertOn=True)
+
+    plt.show()
+
+if __name__ == "__main__":
+    main()
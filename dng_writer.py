@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+'''
+DNG writing helpers shared by the capture and merge tools
+'''
+import io
+import struct
+import numpy as np
+from profiling import profiler
+
+'''
+Lossless compression modes for the CFA mosaic.  Compressed modes are written as tiles, which tifffile
+compresses in parallel across maxworkers threads.
+
+ljpeg is what camera-generated and Adobe DNGs use, and is read by LibRaw/RawTherapee.
+deflate (with horizontal differencing) is a valid TIFF but the DNG spec only allows it for floating point data,
+so LibRaw-based tools refuse to open it.  It's mainly of interest for archiving.
+'''
+compression_modes = {
+    'none': {'compression': None},
+    'deflate': {'compression': 'zlib', 'predictor': True},
+    'ljpeg': {'compression': 'jpeg', 'compressionargs': {'lossless': True, 'bitspersample': 16}},
+}
+
+'''
+EXIF carried over from the capture into the DNG.  The IFD0 tags are written by tifffile along with the image,
+the EXIF IFD is appended after the image data and IFD0's ExifIFD pointer patched to it,
+so the image data is only ever written once.
+'''
+ifd0_exif_tags = {'Make': (271, 's'),
+                'Model': (272, 's'),
+                'Orientation': (274, 'H'),
+                'DateTime': (306, 's')}
+
+#name: (tag, TIFF type)
+exif_ifd_tags = {'ExposureTime': (33434, 5),
+                'FNumber': (33437, 5),
+                'ISOSpeedRatings': (34855, 3),
+                'FocalLength': (37386, 5),
+                'FocalLengthIn35mmFilm': (41989, 3),
+                'LensModel': (42036, 2)}
+
+sony_makernote_tags = (0xb001, #SonyModelID, not sure if we want to keep this?
+                    0xb027) #LensID, needed for RT to get lens data
+
+exififd_tag = 34665
+#tifffile refuses to write ExifIFD itself, so an unused tag sorting just before it holds the pointer until it is patched
+exififd_placeholder_tag = 34664
+makernote_tag = 37500
+exifversion_tag = 36864
+
+#fugly, find a better solution for generating RATIONAL/SRATIONAL
+def cm_to_flatrational(input_array):
+    retarray = np.ones(input_array.size*2, dtype=np.int32)
+    retarray[0::2] = (input_array.flatten()*10000).astype(np.int32)
+    retarray[1::2] = 10000
+    return retarray
+
+def write_dng(output, bayer_data, dng_extratags, compression='none', tile_size=256, workers=None, exif=None):
+    if exif is not None:
+        dng_extratags = dng_extratags + exif_extratags(exif)
+    kwargs = dict(compression_modes[compression])
+    if kwargs['compression'] is not None:
+        kwargs['tile'] = (tile_size, tile_size)
+        kwargs['maxworkers'] = workers
+    #tifffile is imported where it's used, importing it is a good part of the capture tools' -h time
+    import tifffile as TIFF
+    with profiler.stage('write'):
+        with TIFF.TiffWriter(output) as dng:
+            dng.write(bayer_data,
+                    photometric='CFA',
+                    extratags=dng_extratags,
+                    subfiletype=0,
+                    **kwargs)
+    if exif is not None:
+        append_exif_ifd(output, exif)
+
+def memmap_dng(output, shape, dng_extratags, exif=None):
+    #Creates an uncompressed DNG and returns its image data memory-mapped, for writing band by band.
+    #The caller has to flush and drop the map, then call append_exif_ifd() if exif was given.
+    if exif is not None:
+        dng_extratags = dng_extratags + exif_extratags(exif)
+    import tifffile as TIFF
+    return TIFF.memmap(output,
+                shape=shape,
+                dtype=np.uint16,
+                photometric='CFA',
+                extratags=dng_extratags,
+                subfiletype=0)
+
+def parse_sony_makernote(makernote, byteorder):
+    #Sony2 makernotes are a bare IFD, some models prefix it with a SONY DSC/SONY CAM header
+    if makernote[:4] == b'SONY':
+        makernote = makernote[12:]
+    entries = {}
+    if len(makernote) < 2:
+        return entries
+    count = struct.unpack(byteorder + 'H', makernote[:2])[0]
+    for i in range(count):
+        entry = makernote[2 + 12*i:14 + 12*i]
+        if len(entry) < 12:
+            break
+        tag, type_, n = struct.unpack(byteorder + 'HHI', entry[:8])
+        #Only single inline SHORT/LONG values are kept, anything else would need its offsets rebased
+        if tag in sony_makernote_tags and n == 1 and type_ in (3, 4):
+            entries[tag] = (type_, struct.unpack(byteorder + ('H' if type_ == 3 else 'I'), entry[8:10 if type_ == 3 else 12])[0])
+    return entries
+
+def read_exif(source):
+    with profiler.stage('read_exif'):
+        return parse_exif(source)
+
+def parse_exif(source):
+    import tifffile as TIFF
+    fh = source if isinstance(source, str) else io.BytesIO(source)
+    exif = {}
+    with TIFF.TiffFile(fh) as tif:
+        tags = tif.pages[0].tags
+        for name, (code, dtype) in ifd0_exif_tags.items():
+            if code in tags:
+                exif[name] = tags[code].value
+        if exififd_tag in tags:
+            exif_ifd = tags[exififd_tag].value
+            for name in exif_ifd_tags:
+                if name in exif_ifd:
+                    exif[name] = exif_ifd[name]
+            if 'MakerNote' in exif_ifd:
+                exif['MakerNote'] = parse_sony_makernote(exif_ifd['MakerNote'], tif.byteorder)
+    return exif
+
+def exif_extratags(exif):
+    extratags = []
+    for name, (code, dtype) in ifd0_exif_tags.items():
+        if name in exif:
+            value = exif[name]
+            if dtype == 's':
+                extratags.append((code, dtype, 0, value))
+            else:
+                extratags.append((code, dtype, 1, int(value)))
+    #Placeholder for the EXIF IFD pointer, filled in by append_exif_ifd()
+    extratags.append((exififd_placeholder_tag, 'I', 1, 0))
+    return extratags
+
+def pack_value(type_, value, byteorder):
+    if type_ == 2:
+        data = value.encode('ascii', errors='replace') + b'\0'
+        return len(data), data
+    if type_ in (3, 4):
+        values = [int(v) for v in value] if isinstance(value, (tuple, list)) else [int(value)]
+        return len(values), struct.pack(byteorder + ('H' if type_ == 3 else 'I')*len(values), *values)
+    if type_ == 5:
+        return 1, struct.pack(byteorder + 'II', int(value[0]), int(value[1]))
+    return len(value), bytes(value)
+
+def pack_ifd(entries, ifd_offset, byteorder):
+    #Classic TIFF IFD with values that don't fit in 4 bytes stored right after it
+    entries = sorted(entries)
+    data_offset = ifd_offset + 2 + 12*len(entries) + 4
+    ifd = struct.pack(byteorder + 'H', len(entries))
+    data = b''
+    for tag, type_, count, payload in entries:
+        if len(payload) <= 4:
+            ifd += struct.pack(byteorder + 'HHI', tag, type_, count) + payload.ljust(4, b'\0')
+        else:
+            ifd += struct.pack(byteorder + 'HHII', tag, type_, count, data_offset + len(data))
+            data += payload
+            if len(data) % 2:
+                data += b'\0'
+    return ifd + struct.pack(byteorder + 'I', 0) + data
+
+def build_makernote(entries, byteorder):
+    makernote = [(tag, type_, 1, pack_value(type_, value, byteorder)[1]) for tag, (type_, value) in entries.items()]
+    #Makernote offsets would be relative to the DNG, but we only keep inline values so the position doesn't matter
+    return pack_ifd(makernote, 0, byteorder)
+
+def append_exif_ifd(output, exif):
+    with profiler.stage('exif'):
+        append_exif(output, exif)
+
+def append_exif(output, exif):
+    with open(output, 'r+b') as f:
+        header = f.read(8)
+        byteorder = '<' if header[:2] == b'II' else '>'
+        if struct.unpack(byteorder + 'H', header[2:4])[0] != 42:
+            raise ValueError(output + " is not a classic TIFF, can't append EXIF IFD")
+        ifd0 = struct.unpack(byteorder + 'I', header[4:8])[0]
+        f.seek(ifd0)
+        count = struct.unpack(byteorder + 'H', f.read(2))[0]
+        ifd0_entries = f.read(12*count)
+        entry_offset = None
+        for i in range(count):
+            if struct.unpack(byteorder + 'H', ifd0_entries[12*i:12*i + 2])[0] == exififd_placeholder_tag:
+                entry_offset = ifd0 + 2 + 12*i
+        if entry_offset is None:
+            raise ValueError(output + " has no ExifIFD placeholder")
+
+        entries = [(exifversion_tag, 7, 4, b'0231')]
+        for name, (code, type_) in exif_ifd_tags.items():
+            if name in exif:
+                count, payload = pack_value(type_, exif[name], byteorder)
+                entries.append((code, type_, count, payload))
+        if exif.get('MakerNote'):
+            makernote = build_makernote(exif['MakerNote'], byteorder)
+            entries.append((makernote_tag, 7, len(makernote), makernote))
+
+        f.seek(0, 2)
+        if f.tell() % 2:
+            f.write(b'\0')
+        ifd_offset = f.tell()
+        f.write(pack_ifd(entries, ifd_offset, byteorder))
+        f.seek(entry_offset)
+        f.write(struct.pack(byteorder + 'HHII', exififd_tag, 4, 1, ifd_offset))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+'''
+Film characteristic curve model shared by density_plot.py (fitting) and invert_negative.py (applying it).
+
+A film profile is a dict of inref, evdelt, and per-channel exp and cstr, as fitted by density_plot.py.
+build_film_profiles.py fits profiles in bulk into a profile store, a JSON file of
+    {"version": 1, "profiles": {name: profile, ...}}
+'''
+import json
+import os
+import numpy as np
+
+default_profile_store = os.path.join(os.path.expanduser('~'), '.cache', 'rgb_led_filmscan', 'film_profiles.json')
+profile_store_version = 1
+
+filmdata =  {'Fuji Superia X-Tra 400':   {'inref' : np.power(2.0,-9.3014),
+                                        'evdelt' : 2.724,
+                                        'exp' : {'r' : 1.6,
+                                                'g' : 1.48,
+                                                'b' : 1.45},
+                                        'cstr': {'r' : 1.5,
+                                                'g' : 2.0,
+                                                'b' : 2.6}
+                                        },
+            'Kodak Gold 200':   {'inref' : np.power(2.0,-7.95),
+                                        'evdelt' : 4.0,
+                                        'exp' : {'r' : 1.83,
+                                                'g' : 1.72,
+                                                'b' : 1.65},
+                                        'cstr': {'r' : 2.0,
+                                                'g' : 1.8,
+                                                'b' : 3.0}
+                                        }
+            }
+
+def tcoeff_to_scenelin(tcoeff, reflevel, exp, linadj, strexp):
+    scenelin = np.power(tcoeff, -exp)*reflevel
+    return np.power((np.power(scenelin,strexp)-linadj), 1.0/strexp)
+
+def profile_linadj(profile, color):
+    inref = profile['inref']
+    outref = inref*np.power(2.0,-profile['evdelt'])
+    cstr = profile['cstr'][color]
+    return np.power(inref,cstr) - np.power(outref,cstr)
+
+def film_scenelin(tcoeff, profile, color):
+    #Scene light for a transmission coefficient relative to the film base, using the enhanced model
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scenelin = tcoeff_to_scenelin(tcoeff, profile['inref'], profile['exp'][color], profile_linadj(profile, color), profile['cstr'][color])
+    #Anything clearer than the film base falls below the model's range
+    return np.nan_to_num(scenelin, nan=0.0, posinf=np.finfo(np.float64).max)
+
+def read_profile_store(path=default_profile_store):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        store = json.load(f)
+    if store.get('version') != profile_store_version:
+        raise ValueError(path + " is profile store version " + str(store.get('version')) + ", expected " + str(profile_store_version))
+    return store['profiles']
+
+def write_profile_store(profiles, path=default_profile_store):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': profile_store_version, 'profiles': profiles}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def load_film_profile(film, store=default_profile_store):
+    #The name of a built-in profile, the name of a profile in the profile store, or a JSON file holding one
+    if film in filmdata:
+        return filmdata[film]
+    if not os.path.exists(film):
+        profiles = read_profile_store(store)
+        if film in profiles:
+            return profiles[film]
+    with open(film) as f:
+        return json.load(f)
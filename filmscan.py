@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+'''
+Single entry point for the scanning tools:
+    filmscan.py <command> [options]
+runs the main() of the script behind <command> with the remaining options, and `filmscan.py <command> -h`
+shows that script's options.  Only the script for the chosen command is imported, so listing the commands
+doesn't load numpy, rawpy or gphoto2, and each command only pays for its own imports.
+'''
+import argparse
+import importlib
+import sys
+
+commands = {
+    'capture': ('capture_negative', 'capture a roll of negatives, merging each frame to a DNG'),
+    'calibrate': ('calibrate', 'capture dark and flat field masters'),
+    'live': ('live_assist', 'live view exposure assist'),
+    'expose': ('auto_exposure', 'solve shutter speed and light intensities from a metering capture'),
+    'merge': ('batch_merge', 're-merge archived red/green/blue captures'),
+    'invert': ('invert_negative', 'invert a merged negative DNG with a film profile'),
+    'fit': ('density_plot', 'fit and plot the film model for one density CSV'),
+    'profiles': ('build_film_profiles', 'fit every density CSV into the film profile store'),
+    'ssf': ('ssfcsv_to_json', 'convert SSF CSVs to dcamprof JSON'),
+}
+
+def main():
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='commands:\n' + '\n'.join('  {:<11}{}'.format(c, h) for c, (m, h) in commands.items()))
+    ap.add_argument('command', choices=commands.keys(), metavar='command',
+        help='one of the commands below')
+    ap.add_argument('args', nargs=argparse.REMAINDER,
+        help='options for the command, see <command> -h')
+
+    args = vars(ap.parse_args())
+
+    module = importlib.import_module(commands[args['command']][0])
+    #The command parses its own options, and its usage shows up as "filmscan.py <command>"
+    sys.argv = [ap.prog + ' ' + args['command']] + args['args']
+    module.main()
+
+if __name__ == "__main__":
+    main()
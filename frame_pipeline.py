@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+'''
+Bounded producer/consumer pipeline used to overlap camera I/O with raw decoding, merging and DNG writing.
+The producer (the thread talking to gphoto2 and the light) only calls submit(), which blocks once
+`depth` frames are waiting, so a slow disk applies backpressure instead of filling RAM with raw buffers.
+'''
+import queue
+import threading
+from concurrent.futures import Future
+
+class FramePipeline:
+    def __init__(self, process, workers=2, depth=2):
+        self.process = process
+        self.jobs = queue.Queue(maxsize=depth)
+        self.pending = []
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close(raise_errors=(type is None))
+
+    def worker(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                return
+            future, args = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.process(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+
+    def check_errors(self):
+        # Surface worker failures to the producer as early as possible rather than at the end of a roll
+        still_pending = []
+        for future in self.pending:
+            if not future.done():
+                still_pending.append(future)
+            elif future.exception() is not None:
+                raise future.exception()
+        self.pending = still_pending
+
+    def submit(self, *args):
+        self.check_errors()
+        future = Future()
+        self.jobs.put((future, args))
+        self.pending.append(future)
+        return future
+
+    def close(self, raise_errors=True):
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        if raise_errors:
+            self.check_errors()
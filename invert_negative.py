@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+'''
+Inverts a merged negative DNG to a scene-linear CFA DNG using a film profile fitted by density_plot.py.
+
+Every possible 16-bit raw value is pushed through the film model once to build a per-channel lookup table,
+then each CFA site of the mosaic is just a table lookup.
+'''
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import numpy as np
+from dng_writer import compression_modes, read_exif, write_dng
+from film_model import default_profile_store, filmdata, film_scenelin, load_film_profile
+
+cfa_colors = {0: 'r', 1: 'g', 2: 'b'}
+
+#Tags carried over from the negative as-is
+copied_tags = ['CFARepeatPatternDim', 'CFAPattern', 'ColorMatrix1', 'CalibrationIlluminant1',
+            'DNGVersion', 'DNGBackwardVersion', 'AsShotNeutral', 'UniqueCameraModel']
+
+#Rows per band when applying the LUTs in parallel, must be even to keep the CFA phase
+band_rows = 512
+
+#One 65536-entry uint16 table per channel mapping raw values to scene-linear output.
+#film_base is the raw level (above black) of the unexposed film base for each channel,
+#scene light for a density of dmax above the base is mapped to the top of the output range.
+def build_luts(profile, black_level, film_base, dmax):
+    codes = np.arange(65536, dtype=np.float64)
+    scale = max(film_scenelin(np.power(10.0, -dmax), profile, color) for color in 'rgb')
+    luts = {}
+    for color in 'rgb':
+        tcoeff = np.maximum(codes - black_level[color], 0.5)/film_base[color]
+        scenelin = film_scenelin(tcoeff, profile, color)
+        luts[color] = np.clip(np.rint(scenelin/scale*65535), 0, 65535).astype(np.uint16)
+    return luts
+
+def cfa_sites(pattern):
+    for row in range(pattern.shape[0]):
+        for clmn in range(pattern.shape[1]):
+            yield row, clmn, cfa_colors[int(pattern[row, clmn])]
+
+def estimate_film_base(bayer_data, pattern, black_level, percentile=99.9):
+    #The film base (rebate, gaps between frames) is the clearest part of a negative, so take a high percentile
+    #of a decimated plane rather than a max that a single hot pixel would skew
+    levels = {}
+    for row, clmn, color in cfa_sites(pattern):
+        plane = bayer_data[row::pattern.shape[0]*4, clmn::pattern.shape[1]*4]
+        level = np.percentile(plane, percentile) - black_level[color]
+        levels[color] = max(levels.get(color, 0), level)
+    return levels
+
+def apply_luts(bayer_data, pattern, luts, workers=None):
+    output = np.empty_like(bayer_data)
+    def invert_band(start):
+        band = slice(start, start + band_rows)
+        for row, clmn, color in cfa_sites(pattern):
+            np.take(luts[color], bayer_data[band][row::pattern.shape[0], clmn::pattern.shape[1]],
+                    out=output[band][row::pattern.shape[0], clmn::pattern.shape[1]], mode='clip')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(invert_band, range(0, bayer_data.shape[0], band_rows)))
+    return output
+
+def read_negative(path):
+    import tifffile as TIFF
+    with TIFF.TiffFile(path) as tif:
+        page = tif.pages[0]
+        bayer_data = page.asarray()
+        tags = page.tags
+        pattern_dim = tags['CFARepeatPatternDim'].value
+        pattern = np.array(list(tags['CFAPattern'].value), dtype=np.uint8).reshape(pattern_dim)
+        black = np.array(tags['BlackLevel'].value if 'BlackLevel' in tags else 0, dtype=np.float64).flatten()
+        extratags = [(tags[name].code, tags[name].dtype, tags[name].count, tags[name].value)
+                    for name in copied_tags if name in tags]
+    #Black level is either one value or one per CFA site
+    black_level = {}
+    for i, (row, clmn, color) in enumerate(cfa_sites(pattern)):
+        black_level[color] = black[i % black.size]
+    return bayer_data, pattern, black_level, extratags
+
+def invert_negative(input, output, profile, film_base=None, dmax=2.5, compression='none', workers=None):
+    bayer_data, pattern, black_level, extratags = read_negative(input)
+    if film_base is None:
+        film_base = estimate_film_base(bayer_data, pattern, black_level)
+    print("Film base: " + ", ".join("{}={:.0f}".format(c, film_base[c]) for c in 'rgb'))
+
+    start = perf_counter()
+    luts = build_luts(profile, black_level, film_base, dmax)
+    lut_time = perf_counter() - start
+
+    start = perf_counter()
+    inverted = apply_luts(bayer_data, pattern, luts, workers)
+    apply_time = perf_counter() - start
+    print("Built LUTs in {:.0f} ms, inverted {:.1f} MP in {:.0f} ms".format(lut_time*1000, bayer_data.size/1e6, apply_time*1000))
+
+    extratags.append(('BlackLevel', 'H', 1, 0))
+    extratags.append(('WhiteLevel', 'H', 1, 65535))
+    write_dng(output, inverted, extratags, compression, exif=read_exif(input))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input', required=True,
+        help='merged negative DNG')
+    ap.add_argument('-o', '--output', default=None,
+        help='output DNG (default: <input>_positive.dng)')
+    ap.add_argument('-p', '--profile', required=True,
+        help='film profile, either a JSON file, a profile in --profile_store, or one of: ' + ', '.join(filmdata.keys()))
+    ap.add_argument('--profile_store', default=default_profile_store,
+        help='profile store written by build_film_profiles.py')
+    ap.add_argument('-b', '--base', type=float, nargs=3, default=None,
+        help='raw R G B levels above black of the unexposed film base (default: estimated from the image)')
+    ap.add_argument('--dmax', type=float, default=2.5,
+        help='density above the film base that maps to output white')
+    ap.add_argument('--compression', choices=compression_modes.keys(), default='none',
+        help='Lossless DNG compression')
+    ap.add_argument('-j', '--jobs', type=int, default=None,
+        help='threads used to apply the LUTs')
+
+    args = vars(ap.parse_args())
+
+    output = args['output'] or os.path.splitext(args['input'])[0] + '_positive.dng'
+    film_base = dict(zip('rgb', args['base'])) if args['base'] is not None else None
+    invert_negative(args['input'], output, load_film_profile(args['profile'], args['profile_store']), film_base,
+                    args['dmax'], args['compression'], args['jobs'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+'''
+Live exposure assist: cycles the light through red, green and blue and meters each from the camera's live view,
+so --shutter_speed and --rgb can be dialled in without a single raw capture.
+
+Live view frames are JPEGs, decoded at reduced size straight from the DCT coefficients, and only the channel that
+is lit is looked at.  For each channel a histogram, the clipped fraction and a few percentiles are shown, along
+with the brightness that would put the metered percentile at --target of white.  The JPEG tone curve is undone
+with the sRGB curve, so the suggestion is approximate, but close enough that one raw capture confirms it.
+The camera has to show exposure settings in live view (Sony: Live View Display = Setting Effect ON).
+'''
+import argparse
+import io
+from time import sleep, monotonic
+import numpy as np
+from capture_negative import CaptureSession, channel_hues, load_gphoto2, make_light
+
+#Plane of the decoded preview that each channel lights
+channel_planes = {'red': 0, 'green': 1, 'blue': 2}
+
+hist_bins = 32
+hist_chars = ' .:-=+*#%@'
+
+def srgb_to_linear(code):
+    v = code/255.0
+    return np.where(v <= 0.04045, v/12.92, np.power((v + 0.055)/1.055, 2.4))
+
+#Linear level for each 8-bit code
+linear_lut = srgb_to_linear(np.arange(256))
+
+def decode_preview(data, scale=4):
+    from PIL import Image
+    image = Image.open(io.BytesIO(data))
+    #Lets libjpeg decode at 1/2, 1/4 or 1/8 size, which is far cheaper than decoding full size and decimating
+    image.draft('RGB', (image.width//scale, image.height//scale))
+    return np.asarray(image.convert('RGB'))
+
+def channel_stats(plane, percentiles):
+    #Everything comes from the 256-bin histogram, so there's no sort of the plane
+    hist = np.bincount(plane.ravel(), minlength=256)
+    cumulative = np.cumsum(hist)/plane.size
+    levels = {p: int(np.searchsorted(cumulative, p/100.0)) for p in percentiles}
+    return hist, levels, hist[255]/plane.size
+
+def suggest_brightness(bright, code, clipped, target):
+    #LED output is close enough to linear in brightness for a starting point.  Not clamped to 100, so the
+    #caller can tell how far off the shutter speed is.
+    if clipped > 0.001 or code >= 255:
+        return max(1, bright//2)
+    return bright*target/linear_lut[max(code, 1)]
+
+def format_histogram(hist):
+    binned = hist[:256 - 256 % hist_bins].reshape(hist_bins, -1).sum(axis=1)
+    scaled = np.log1p(binned)/max(np.log1p(binned.max()), 1e-9)
+    return ''.join(hist_chars[int(v*(len(hist_chars) - 1))] for v in scaled)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-s', '--shutter_speed', required=True,
+                    help='Shutter Speed')
+    ap.add_argument('-r', '--rgb', nargs=3, type=int, default=[50, 50, 50],
+                    help='Starting RGB intensities for Neewer light, 0-100')
+    ap.add_argument('-a', '--address', required=False, type=str, nargs='+',
+                    help='BLE address of Neewer light (default: the last light used, or the first one found)')
+    ap.add_argument('--light_timeout', type=float, default=10.0,
+                    help='Seconds to scan for the Neewer light before giving up.  Only a light paired with this computer is connected to without a scan')
+    ap.add_argument('--led_settle', type=float, default=0.05,
+                    help='Seconds to wait for the LEDs and live view to settle after a color change')
+    ap.add_argument('-p', '--percentile', type=float, default=99.5,
+                    help='Percentile of each channel that should land at --target')
+    ap.add_argument('--target', type=float, default=0.85,
+                    help='Linear level, as a fraction of white, to put the metered percentile at')
+    ap.add_argument('--scale', type=int, choices=[1, 2, 4, 8], default=4,
+                    help='Preview decode downscale factor')
+    ap.add_argument('--follow', action='store_true',
+                    help='Apply the suggested intensities on the next cycle instead of keeping --rgb')
+    ap.add_argument('-n', '--cycles', type=int, default=None,
+                    help='Stop after this many R/G/B cycles (default: until Ctrl-C)')
+    ap.add_argument('--simulate', action='store_true',
+                    help='Use a simulated camera and light (see simulated.py) instead of real hardware')
+
+    args = vars(ap.parse_args())
+
+    if args['simulate']:
+        from simulated import Rig
+        backend = Rig()
+        light = backend.light()
+    else:
+        backend = load_gphoto2()
+        if backend is None:
+            ap.error('gphoto2 is not installed, only --simulate is available')
+        light = make_light(args['address'])
+
+    percentiles = (50, 99, args['percentile'])
+    bright = dict(zip(channel_hues.keys(), args['rgb']))
+    suggested = dict(bright)
+    with light:
+        with CaptureSession(light, args['shutter_speed'], args['led_settle'], backend=backend) as session:
+            print("Discovering Neewer light")
+            light.find_device(args['light_timeout'])
+            if(light.neewer_device is None):
+                exit(1)
+
+            print("\n{:<6} {:>4}  {:>4} {:>4} {:>5}  {:>7}  {:<{}}  {}".format(
+                'color', 'set', 'p50', 'p99', 'p' + format(args['percentile'], 'g'), 'clipped', 'histogram', hist_bins, 'suggest'))
+            cycle = 0
+            try:
+                while args['cycles'] is None or cycle < args['cycles']:
+                    start = monotonic()
+                    lines = []
+                    for channel, hue in channel_hues.items():
+                        if light.set_HSI(hue, 100, bright[channel]) is not None:
+                            sleep(args['led_settle'])
+                        preview = decode_preview(session.camera.capture_preview().get_data_and_size(), args['scale'])
+                        hist, levels, clipped = channel_stats(preview[..., channel_planes[channel]], percentiles)
+                        suggested[channel] = suggest_brightness(bright[channel], levels[args['percentile']], clipped, args['target'])
+                        lines.append("{:<6} {:>4}  {:>4} {:>4} {:>5}  {:>6.2f}%  {}  {}".format(
+                            channel, bright[channel], *(levels[p] for p in percentiles), clipped*100, format_histogram(hist),
+                            int(np.clip(round(suggested[channel]), 1, 100))))
+                    #Redraw the channel lines and the rate line in place
+                    if cycle > 0:
+                        print('\x1b[4F', end='')
+                    print('\n'.join(lines))
+                    print("{:.1f} cycles/s".format(1/(monotonic() - start)) + ' '*20)
+                    if args['follow']:
+                        bright = {c: int(np.clip(round(b), 1, 100)) for c, b in suggested.items()}
+                    cycle += 1
+            except KeyboardInterrupt:
+                pass
+            #Nothing waits on the light going off, leaving the light sends it before disconnecting
+            light.set_HSI(0, 100, 0, wait=False)
+
+    print("\nSuggested: -s " + args['shutter_speed'] + " -r " + " ".join(str(int(np.clip(round(suggested[c]), 1, 100))) for c in channel_hues))
+    if max(suggested.values()) > 100:
+        print("Even full brightness is {:.1f} stops short, use a longer shutter speed".format(np.log2(max(suggested.values())/100)))
+
+if __name__ == "__main__":
+    main()
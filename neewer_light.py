@@ -1,13 +1,58 @@
 #!/usr/bin/env python3
 
-import simplepyble
+import json
+import os
 import struct
-from time import sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import sleep, monotonic
+
+#Last light we connected to, so the next session can go straight to it instead of waiting for a full scan
+default_cache_file = os.path.join(os.path.expanduser('~'), '.cache', 'rgb_led_filmscan', 'neewer_light.json')
+
+#Upper edges in ms of the command latency histogram buckets
+latency_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')]
+
+#A roll only ever uses a handful of distinct commands, so build each packet once
+@lru_cache(maxsize=None)
+def hsi_packet(hue, sat, bright):
+    prefix = bytes.fromhex('788604')
+
+    cmd = prefix + struct.pack('<HBB',hue, sat, bright)
+    return cmd + bytes((sum(cmd) & 0xff,))
+
+def latency_histogram(latencies):
+    counts = [0]*len(latency_buckets)
+    for latency in latencies:
+        for i, edge in enumerate(latency_buckets):
+            if latency*1000 <= edge:
+                counts[i] += 1
+                break
+    return list(zip(latency_buckets, counts))
+
+def format_latency_histogram(latencies):
+    lines = []
+    for edge, count in latency_histogram(latencies):
+        label = '<= {:g} ms'.format(edge) if edge != float('inf') else '> {:g} ms'.format(latency_buckets[-2])
+        lines.append('{:>12} {:6d} '.format(label, count) + '#'*min(count, 60))
+    return '\n'.join(lines)
 
 class NeewerLight:
-    def __init__(self, address = None):
+    def __init__(self, address = None, cache_file = default_cache_file, acknowledge = True):
         #FIXME:  Filter by address if there are ever multiple Neewer lights around
         self.address = address
+        self.cache_file = cache_file
+        #write_request waits for the light to acknowledge the command, write_command doesn't
+        self.acknowledge = acknowledge
+        self.target_address = None
+        self.last_packet = None
+        self.pending = None
+        self.flush_scheduled = False
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
         self.set_light_uuid = "69400002-b5a3-f393-e0a9-e50e24dcca99"
         self.set_light_service_uuid = "69400001-b5a3-f393-e0a9-e50e24dcca99"
         self.neewer_device = None
@@ -20,30 +65,110 @@ class NeewerLight:
 
     def scan_found_callback(self, device):
         print(f"Found {device.identifier()} [{device.address()}]")
-        if self.address is not None:
-            if(self.address == device.address()):
-                print("Found device with requested address " + self.address)
-                self.adapter.scan_stop()
+        if self.neewer_device is not None:
+            return
+        if self.target_address is not None:
+            if(self.target_address == device.address()):
+                print("Found device with requested address " + self.target_address)
                 self.neewer_device = device
-        else:
+        elif self.address is None:
             if 52977 in device.manufacturer_data().keys():
                 print("Found Neewer device with address: " + device.address())
-                self.adapter.scan_stop()
                 self.neewer_device = device
 
-    def find_device(self):
+    def load_cached_address(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f).get('address')
+        except (OSError, ValueError):
+            return None
+
+    def save_cached_address(self):
+        if self.cache_file is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, 'w') as f:
+                json.dump({'address': self.neewer_device.address(),
+                        'identifier': self.neewer_device.identifier()}, f)
+        except OSError as e:
+            print("Couldn't cache light address: " + str(e))
+
+    def scan(self, timeout):
+        self.adapter.scan_start()
+        deadline = monotonic() + timeout
+        while self.neewer_device is None and monotonic() < deadline:
+            sleep(0.05)
+        if self.adapter.scan_is_active():
+            self.adapter.scan_stop()
+
+    def find_device(self, timeout = 10.0):
+        #timeout covers all scanning, a cached light that isn't seen only gets half of it before any light will do
+        start = monotonic()
+        #Only needed to talk to a real light, imported here so -h and --simulate don't load the Bluetooth stack
+        try:
+            import simplepyble
+        except ImportError:
+            print("simplepyble is not installed, can't talk to the light")
+            return None
         adapters = simplepyble.Adapter.get_adapters()
+        if len(adapters) == 0:
+            print("No Bluetooth adapter found")
+            return None
         self.adapter = adapters[0]
 
         self.adapter.set_callback_on_scan_start(lambda: print("Scan started."))
         self.adapter.set_callback_on_scan_stop(lambda: print("Scan complete."))
         self.adapter.set_callback_on_scan_found(lambda device: self.scan_found_callback(device))
 
-        self.adapter.scan_start()
-        #FIXME:  Implement a timeout here.
-        while(self.adapter.scan_is_active()):
-            sleep(0.1)
+        cached_address = self.load_cached_address() if self.address is None else None
+        self.target_address = self.address if self.address is not None else cached_address
+
+        if self.target_address is not None:
+            #A paired light can be connected to without scanning at all
+            for device in self.adapter.get_paired_peripherals():
+                if device.address() == self.target_address:
+                    print("Using paired device " + self.target_address)
+                    self.neewer_device = device
+
+        if self.neewer_device is None:
+            self.scan(timeout/2 if cached_address is not None else timeout)
+
+        if self.neewer_device is None and cached_address is not None:
+            print("Cached light " + cached_address + " not seen, scanning for any Neewer light")
+            self.target_address = None
+            self.scan(timeout - (monotonic() - start))
+
+        if self.neewer_device is None:
+            print("No Neewer light found within {:.1f}s, is it switched on and in range?".format(monotonic() - start))
+            return None
 
+        #Connect now so that set_HSI never pays the connection cost on the capture path
+        self.connect()
+        self.save_cached_address()
+        return self.neewer_device
+
+    def connect(self):
+        if not self.neewer_device.is_connected():
+            print("Connecting")
+            start = monotonic()
+            self.neewer_device.connect()
+            print("Connected in {:.0f} ms".format((monotonic() - start)*1000))
+
+    def reconnect(self):
+        #After a dropped link the light's state is unknown, so the next set_HSI is always sent
+        with self.write_lock:
+            self.last_packet = None
+            if self.neewer_device is None:
+                return
+            try:
+                if self.neewer_device.is_connected():
+                    self.neewer_device.disconnect()
+            except Exception as e:
+                print("Disconnecting failed: " + str(e))
+            self.connect()
 
     def get_characteristic(self):
         #FIXME:  Implement error handling for when the light is not found
@@ -61,23 +186,105 @@ class NeewerLight:
                 self.characteristic = characteristic
 
     def __exit__(self, type, value, traceback):
+        self.executor.shutdown()
         if self.neewer_device is not None:
             if self.neewer_device.is_connected():
                 print("Disconnecting")
                 self.neewer_device.disconnect()
 
-    def set_HSI(self, hue, sat, bright):
-        if(self.neewer_device is not None):
-            if(not self.neewer_device.is_connected()):
-                print("Connecting")
-                self.neewer_device.connect()
-            print("Setting light to " + str(hue) + " " + str(sat) + " " + str(bright))
-            prefix = bytes.fromhex('788604')
+    def send(self, packet):
+        #Returns the time the write took, or None if the light is already in that state
+        with self.write_lock:
+            if self.neewer_device is None or packet == self.last_packet:
+                return None
+            #Normally already connected by find_device(), this only happens if the link dropped
+            self.connect()
+            start = monotonic()
+            if self.acknowledge:
+                self.neewer_device.write_request(self.set_light_service_uuid, self.set_light_uuid, packet)
+            else:
+                self.neewer_device.write_command(self.set_light_service_uuid, self.set_light_uuid, packet)
+            latency = monotonic() - start
+            self.last_packet = packet
+            self.latencies.append(latency)
+            return latency
+
+    def post(self, packet):
+        #Fire and forget.  If a command is still waiting to be sent it is superseded rather than queued behind.
+        with self.lock:
+            self.pending = packet
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        self.executor.submit(self.flush)
+
+    def flush(self):
+        with self.lock:
+            packet = self.pending
+            self.pending = None
+            self.flush_scheduled = False
+        self.send(packet)
+
+    def set_HSI(self, hue, sat, bright, wait = True):
+        packet = hsi_packet(hue, sat, bright)
+        if wait:
+            return self.send(packet)
+        self.post(packet)
+
+    def latency_histogram(self):
+        return latency_histogram(self.latencies)
+
+class NeewerLightGroup:
+    '''
+    Drives several lights as one.  Each light has its own sender thread, so a color change
+    costs the slowest light's write rather than the sum of all of them.
+    '''
+    def __init__(self, addresses, acknowledge = True):
+        self.lights = [NeewerLight(address=address, cache_file=None, acknowledge=acknowledge) for address in addresses]
+        self.latencies = []
+
+    def __enter__(self):
+        for light in self.lights:
+            light.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for light in self.lights:
+            light.__exit__(type, value, traceback)
+
+    @property
+    def neewer_device(self):
+        devices = [light.neewer_device for light in self.lights]
+        return None if None in devices else devices
+
+    def find_device(self, timeout = 10.0):
+        #Scans share the adapter, so lights are found one after the other, each within what's left of timeout
+        deadline = monotonic() + timeout
+        for light in self.lights:
+            if light.find_device(max(0.0, deadline - monotonic())) is None:
+                return None
+        return self.neewer_device
+
+    def set_HSI(self, hue, sat, bright, wait = True):
+        packet = hsi_packet(hue, sat, bright)
+        if not wait:
+            for light in self.lights:
+                light.post(packet)
+            return None
+        start = monotonic()
+        futures = [light.executor.submit(light.send, packet) for light in self.lights]
+        if all(future.result() is None for future in futures):
+            return None
+        latency = monotonic() - start
+        self.latencies.append(latency)
+        return latency
 
-            cmd = prefix + struct.pack('<HBB',hue, sat, bright)
-            cmd = cmd + bytes((sum(cmd) & 0xff,))
+    def reconnect(self):
+        for light in self.lights:
+            light.reconnect()
 
-            self.neewer_device.write_request(self.set_light_service_uuid, self.set_light_uuid, cmd)
+    def latency_histogram(self):
+        return latency_histogram(self.latencies)
 
 if __name__ == "__main__":
     from time import sleep
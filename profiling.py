@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+'''
+Per-stage timing for the capture and merge path.
+
+Code wraps each stage in `with profiler.stage('name'):`, which costs next to nothing until enable() is called.
+Once enabled, every stage is written as a JSON line with its frame, thread, start (seconds since enable()) and
+duration, and memory() adds a line with the process' peak RSS since the previous call, so with one frame in
+flight it's that frame's high-water mark.  summary() gives p50/p95 per stage for the end of a roll.
+'''
+import json
+import resource
+import sys
+import threading
+from contextlib import contextmanager
+from time import monotonic
+import numpy as np
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.output = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.durations = {}
+        self.t0 = monotonic()
+
+    def enable(self, output=None):
+        #output is a path for the JSON lines, or None to only collect the summary
+        self.enabled = True
+        self.output = open(output, 'w') if output is not None else None
+        self.durations = {}
+        self.t0 = monotonic()
+        reset_peak_rss()
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+    def emit(self, record):
+        if self.output is None:
+            return
+        with self.lock:
+            self.output.write(json.dumps(record) + '\n')
+            self.output.flush()
+
+    @contextmanager
+    def frame(self, label):
+        #Stages recorded on this thread inside the block are attributed to the given frame
+        previous = getattr(self.local, 'frame', None)
+        self.local.frame = label
+        try:
+            yield
+        finally:
+            self.local.frame = previous
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = monotonic()
+        try:
+            yield
+        finally:
+            end = monotonic()
+            with self.lock:
+                self.durations.setdefault(name, []).append(end - start)
+            self.emit({'stage': name,
+                    'frame': getattr(self.local, 'frame', None),
+                    'thread': threading.current_thread().name,
+                    'start': round(start - self.t0, 6),
+                    'duration': round(end - start, 6)})
+
+    def memory(self, frame=None):
+        if not self.enabled:
+            return
+        peak = peak_rss()
+        reset_peak_rss()
+        self.emit({'memory': frame, 'peak_rss_mb': round(peak/1e6, 1), 'time': round(monotonic() - self.t0, 6)})
+
+    def summary(self):
+        lines = ['{:<12} {:>6} {:>10} {:>10} {:>10}'.format('stage', 'count', 'p50 ms', 'p95 ms', 'total s')]
+        with self.lock:
+            durations = {name: np.array(values) for name, values in self.durations.items()}
+        for name, values in sorted(durations.items(), key=lambda item: -item[1].sum()):
+            p50, p95 = np.percentile(values, [50, 95])*1000
+            lines.append('{:<12} {:>6d} {:>10.1f} {:>10.1f} {:>10.2f}'.format(name, values.size, p50, p95, values.sum()))
+        return '\n'.join(lines)
+
+def peak_rss():
+    #Peak resident set size in bytes.  On Linux VmHWM can be reset, ru_maxrss is the peak for the whole process.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #bytes on macOS, kB everywhere else
+    return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+#Shared by all modules, disabled unless a tool calls profiler.enable()
+profiler = Profiler()
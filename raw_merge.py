@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+'''
+Merges red, green and blue captures of a frame into a single CFA DNG.
+Used live by capture_negative.py and offline by batch_merge.py.
+'''
+import io
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dng_writer import append_exif_ifd, cm_to_flatrational, memmap_dng, read_exif, write_dng
+from registration import measure_shifts
+from profiling import profiler
+
+#CFA colors (as in rawpy's raw_pattern) that each capture contributes to the merged mosaic
+channel_cfa = {'red': (0,), 'green': (1, 3), 'blue': (2,)}
+cfa_names = {0: 'Red', 1: 'Green', 2: 'Blue', 3: 'Green2'}
+
+#Fraction of the white level above which a bracketed sample counts as clipped
+saturation = 0.98
+
+#Captures are either a path to a raw file or an in-memory buffer straight from the camera
+def open_raw(source):
+    #Imported on first use, so the capture tools' -h doesn't pay for LibRaw
+    import rawpy
+    with profiler.stage('open_raw'):
+        if isinstance(source, str):
+            return rawpy.imread(source)
+        return rawpy.imread(io.BytesIO(source))
+
+def unpack(rawfile):
+    #LibRaw only decodes the raw data the first time raw_image is accessed
+    with profiler.stage('unpack'):
+        return rawfile.raw_image
+
+def raw_metadata(rawfile, source):
+    bayer_pattern = rawfile.raw_pattern.astype(np.uint8)
+    BlackLevel_perChannel = np.array(rawfile.black_level_per_channel, dtype=np.uint16)
+    blacklevel_array = np.array(BlackLevel_perChannel)[bayer_pattern].astype(np.uint16)
+    #Lens, exposure and camera EXIF from the capture, emitted into the DNG as it is written
+    return {'bayer_pattern': bayer_pattern,
+            'white_level': rawfile.white_level,
+            'black_level': blacklevel_array,
+            'color_matrix': rawfile.rgb_xyz_matrix,
+            'exif': read_exif(source)}
+
+def merge_mosaic(red_file, green_file, blue_file, verbose=True, calibration=None):
+    #Only one decode is alive at a time, and each one copies just its own CFA sites into the preallocated mosaic
+    bayer_data = None
+    for channel, source in zip(channel_cfa.keys(), (red_file, green_file, blue_file)):
+        with open_raw(source) as rawfile:
+            #raw_image is a view of LibRaw's buffer, so it is only valid until the handle is closed
+            raw_image = unpack(rawfile)
+            if bayer_data is None:
+                bayer_data = np.empty(raw_image.shape, dtype=np.uint16)
+            elif raw_image.shape != bayer_data.shape:
+                raise ValueError(channel + " capture is " + str(raw_image.shape) + ", expected " + str(bayer_data.shape))
+
+            for color in channel_cfa[channel]:
+                row, clmn = np.argwhere(rawfile.raw_pattern == color)[0]
+                plane = bayer_data[row::2, clmn::2]
+                with profiler.stage('merge'):
+                    plane[...] = raw_image[row::2, clmn::2]
+
+            if channel == 'blue':
+                #This is the last image, pull all of the other metadata we need for our DNG
+                metadata = raw_metadata(rawfile, blue_file)
+                raw_pattern = rawfile.raw_pattern.copy()
+
+    if calibration is not None:
+        correction = calibration.lookup(metadata['exif'])
+        with profiler.stage('calibrate'):
+            for row in range(raw_pattern.shape[0]):
+                for clmn in range(raw_pattern.shape[1]):
+                    correction(bayer_data[row::2, clmn::2], slice(None), row, clmn)
+
+    #After the correction and in CFA color order, as merge_channels_tiled() reports them
+    if verbose:
+        for color in sorted(cfa_names):
+            row, clmn = np.argwhere(raw_pattern == color)[0]
+            plane = bayer_data[row::2, clmn::2]
+            print(cfa_names[color] + " max:" + str(np.amax(plane)))
+            print(cfa_names[color] + " min:" + str(np.amin(plane)))
+
+    """
+        for i in range(blacklevel_array.shape[0]):
+            for j in range(blacklevel_array.shape[1]):
+                bayer_data[i::blacklevel_array.shape[0], j::blacklevel_array.shape[1]] -= blacklevel_array[i][j]
+
+        avg_blacklevel = np.mean(BlackLevel_perChannel)
+        wpoint = 65504 #Largest value representable in a float16
+        bayer_data *= wpoint/(WhiteLevel - avg_blacklevel)
+
+        if(np.amax(bayer_data) > 65504):
+            scalefac = 65504/np.amax(bayer_data)
+            bayer_data *= scalefac
+            wpoint *= scalefac
+    """
+    return bayer_data, metadata
+
+def check_registration(bayer_data, metadata, output):
+    #capture_negative.py logs the shifts under the frame's final name and decides what to do about them
+    with profiler.stage('register'):
+        return measure_shifts(bayer_data, metadata['bayer_pattern'])
+
+def dng_tags(metadata):
+    bayer_pattern = metadata['bayer_pattern'].copy()
+    blacklevel_array = metadata['black_level']
+    WhiteLevel = metadata['white_level']
+    exif = metadata['exif']
+
+    #RT crashes badly if we preserve G1 as 3 instead of mapping it to 1.  TODO:  Check what DNG spec says about this.
+    bayer_pattern[bayer_pattern == 3] = 1
+
+    #FIXME:  Handle this better/more flexibly/more cleanly
+    #FIXME:  The camera color metadata is meaningless for an RGB capture like this, figure out an appropriate cmatrix.  Fixing that likely fixes the prior FIXME
+    cmatrix = metadata['color_matrix'][:-1,:]
+
+    unique_cam_model = exif['Make'] + " " + exif['Model']
+
+    dng_extratags = []
+    dng_extratags.append(('CFARepeatPatternDim', 'H', len(bayer_pattern.shape), bayer_pattern.shape, 0))
+    dng_extratags.append(('CFAPattern', 'B', bayer_pattern.size, bayer_pattern.flatten()))
+    dng_extratags.append(('ColorMatrix1', '2i', cmatrix.size, cm_to_flatrational(cmatrix)))
+    dng_extratags.append(('CalibrationIlluminant1', 'H', 1, 21)) #is there an enum for this in tifffile???
+    dng_extratags.append(('BlackLevelRepeatDim', 'H', 2, blacklevel_array.shape)) #BlackLevelRepeatDim
+    dng_extratags.append(('BlackLevel', 'H', blacklevel_array.size, blacklevel_array.flatten().astype(np.uint16))) #We subtracted the black level already
+    dng_extratags.append(('WhiteLevel', 'H', 1, WhiteLevel)) #WhiteLevel, scaled by us to the max for a float64
+    dng_extratags.append(('DNGVersion', 'B', 4, [1,4,0,0])) #DNGVersion
+    dng_extratags.append(('DNGBackwardVersion', 'B', 4, [1,4,0,0])) #DNGBackwardVersion
+    #Since we normalized our channels, our AsShotNeutral is close to 1
+    #FIXME: Derive AsShotNeutral from the maximum of each channel
+    dng_extratags.append(('AsShotNeutral', '2I', 3, np.array([1,1,1,1,1,1], dtype=np.uint32)))
+    dng_extratags.append(('UniqueCameraModel', 's', len(unique_cam_model), unique_cam_model))
+
+    return dng_extratags
+
+'''
+Tiled merge for frames too big to hold in RAM: the output DNG's image data is memory-mapped and each capture
+is copied into it band by band on a thread pool (NumPy releases the GIL for the copies and reductions),
+with channel stats and an optional per-pixel correction computed on each band as it goes.
+Apart from LibRaw's own decode of the current capture, memory use is bounded by band_rows, not the image size.
+calibration, if given, provides the correction through lookup(exif), which is called as
+correction(plane, band, row, clmn) with the band's view of CFA site (row, clmn) and modifies it in place.
+'''
+def merge_channels_tiled(red_file, green_file, blue_file, output, band_rows=256, workers=None, calibration=None, verbose=True,
+                        register=False):
+    sources = {'red': red_file, 'green': green_file, 'blue': blue_file}
+    #Bands have to start on an even row to keep the CFA phase
+    band_rows += band_rows % 2
+    bayer_data = None
+    stats = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        #Blue first, as its metadata is needed to create the output file
+        for channel in ('blue', 'red', 'green'):
+            with open_raw(sources[channel]) as rawfile:
+                raw_image = unpack(rawfile)
+                if bayer_data is None:
+                    metadata = raw_metadata(rawfile, blue_file)
+                    bayer_data = memmap_dng(output, raw_image.shape, dng_tags(metadata), metadata['exif'])
+                    correction = calibration.lookup(metadata['exif']) if calibration is not None else None
+                elif raw_image.shape != bayer_data.shape:
+                    raise ValueError(channel + " capture is " + str(raw_image.shape) + ", expected " + str(bayer_data.shape))
+
+                sites = [(color,) + tuple(np.argwhere(rawfile.raw_pattern == color)[0]) for color in channel_cfa[channel]]
+
+                def merge_band(start):
+                    band = slice(start, start + band_rows)
+                    band_stats = []
+                    for color, row, clmn in sites:
+                        plane = bayer_data[band][row::2, clmn::2]
+                        if plane.size == 0:
+                            continue
+                        plane[...] = raw_image[band][row::2, clmn::2]
+                        if correction is not None:
+                            correction(plane, band, row, clmn)
+                        band_stats.append((color, np.amax(plane), np.amin(plane)))
+                    return band_stats
+
+                with profiler.stage('merge'):
+                    for band_stats in executor.map(merge_band, range(0, raw_image.shape[0], band_rows)):
+                        for color, band_max, band_min in band_stats:
+                            color_max, color_min = stats.get(color, (band_max, band_min))
+                            stats[color] = (max(color_max, band_max), min(color_min, band_min))
+            with profiler.stage('write'):
+                bayer_data.flush()
+
+    shifts = check_registration(bayer_data, metadata, output) if register else None
+    del bayer_data
+    append_exif_ifd(output, metadata['exif'])
+
+    if verbose:
+        for color in sorted(stats):
+            print(cfa_names[color] + " max:" + str(stats[color][0]))
+            print(cfa_names[color] + " min:" + str(stats[color][1]))
+    return stats, shifts
+
+#Returns the red and blue shifts relative to green from registration.measure_shifts() if register is set, else None
+def merge_channels(red_file, green_file, blue_file, output, compression='none', tile_size=256, verbose=True, tiled=False, band_rows=256,
+                calibration=None, register=False):
+    if tiled:
+        if compression != 'none':
+            raise ValueError("Tiled merging writes through a memory map, which only works for uncompressed DNGs")
+        stats, shifts = merge_channels_tiled(red_file, green_file, blue_file, output, band_rows, calibration=calibration,
+                                            verbose=verbose, register=register)
+        return shifts
+    bayer_data, metadata = merge_mosaic(red_file, green_file, blue_file, verbose, calibration)
+    shifts = check_registration(bayer_data, metadata, output) if register else None
+    write_dng(output, bayer_data, dng_tags(metadata), compression, tile_size, exif=metadata['exif'])
+    return shifts
+
+'''
+Multi-shot stacking: each channel is captured several times, optionally at several shutter speeds, and every shot is
+folded into float32 accumulators holding only the CFA sites that channel contributes, so memory doesn't grow with
+the number of shots.  Plain repeats are averaged.  Bracketed shots are combined as sum(raw - black)/sum(exposure time)
+over the samples that aren't clipped, i.e. longer exposures get more weight, and scaled back to the shortest exposure.
+merge_stacks() then scales the result up to the full 16 bits so the extra precision survives in the DNG.
+'''
+class ChannelStack:
+    def __init__(self, channel, bracket=False, calibration=None):
+        self.channel = channel
+        self.bracket = bracket
+        self.calibration = calibration
+        self.metadata = None
+        self.shape = None
+        self.planes = {}
+        self.weights = {}
+        self.count = 0
+        self.min_exposure = None
+
+    def add(self, source, exposure_time):
+        with open_raw(source) as rawfile:
+            raw_image = unpack(rawfile)
+            if self.metadata is None:
+                self.metadata = raw_metadata(rawfile, source)
+                self.shape = raw_image.shape
+            elif raw_image.shape != self.shape:
+                raise ValueError(self.channel + " shot is " + str(raw_image.shape) + ", expected " + str(self.shape))
+            correction = None
+            if self.calibration is not None:
+                correction = self.calibration.lookup(read_exif(source) if self.bracket else self.metadata['exif'])
+
+            for color in channel_cfa[self.channel]:
+                row, clmn = np.argwhere(rawfile.raw_pattern == color)[0]
+                with profiler.stage('stack'):
+                    shot = raw_image[row::2, clmn::2].astype(np.float32)
+                    if correction is not None:
+                        correction(shot, slice(None), row, clmn)
+                    if color not in self.planes:
+                        self.planes[color] = (row, clmn, np.zeros(shot.shape, dtype=np.float32))
+                        if self.bracket:
+                            self.weights[color] = np.zeros(shot.shape, dtype=np.float32)
+                    plane = self.planes[color][2]
+                    if not self.bracket:
+                        plane += shot
+                        continue
+                    clipped = raw_image[row::2, clmn::2] >= saturation*self.metadata['white_level']
+                    shot -= self.metadata['black_level'][row, clmn]
+                    shot[clipped] = 0
+                    plane += shot
+                    self.weights[color] += np.where(clipped, 0, np.float32(exposure_time))
+        self.count += 1
+        if self.min_exposure is None or exposure_time < self.min_exposure:
+            self.min_exposure = exposure_time
+
+    def mean(self):
+        #Yields (color, row, clmn, plane) in raw units at the shortest exposure
+        for color, (row, clmn, plane) in self.planes.items():
+            if not self.bracket:
+                yield color, row, clmn, plane/self.count
+                continue
+            black = self.metadata['black_level'][row, clmn]
+            weight = self.weights[color]
+            #Clipped in every shot, so all we know is that it's at least white
+            mean = np.full(plane.shape, self.metadata['white_level'], dtype=np.float32)
+            np.divide(plane, weight, out=mean, where=weight > 0)
+            mean[weight > 0] *= np.float32(self.min_exposure)
+            mean[weight > 0] += black
+            yield color, row, clmn, mean
+
+def merge_stacks(red_stack, green_stack, blue_stack, output, compression='none', tile_size=256, verbose=True, register=False):
+    metadata = dict(blue_stack.metadata)
+    scale = max(1, 65535//metadata['white_level'])
+    bayer_data = np.empty(blue_stack.shape, dtype=np.uint16)
+    for stack in (red_stack, green_stack, blue_stack):
+        if stack.shape != blue_stack.shape:
+            raise ValueError(stack.channel + " stack is " + str(stack.shape) + ", expected " + str(blue_stack.shape))
+        for color, row, clmn, mean in stack.mean():
+            mean *= scale
+            np.clip(mean, 0, 65535, out=mean)
+            plane = bayer_data[row::2, clmn::2]
+            plane[...] = np.rint(mean)
+            if verbose:
+                print(cfa_names[color] + " max:" + str(np.amax(plane)))
+                print(cfa_names[color] + " min:" + str(np.amin(plane)))
+
+    metadata['black_level'] = (metadata['black_level']*scale).astype(np.uint16)
+    metadata['white_level'] = min(65535, metadata['white_level']*scale)
+    metadata['exif'] = dict(metadata['exif'])
+    exposure = blue_stack.min_exposure
+    metadata['exif']['ExposureTime'] = (exposure.numerator, exposure.denominator)
+    shifts = check_registration(bayer_data, metadata, output) if register else None
+    write_dng(output, bayer_data, dng_tags(metadata), compression, tile_size, exif=metadata['exif'])
+    return shifts
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+'''
+Checks that the red, green and blue captures of a frame line up before they're trusted as one mosaic.
+
+The shift of the red and blue CFA planes relative to green is found by FFT phase correlation in two steps.  The whole
+planes are block-averaged down 16x (a 60 MP mosaic becomes about 300x200) for a coarse shift that can be large, then
+a full-resolution crop from the middle of the frame, offset by the coarse shift, gives the remainder to a fraction of a
+pixel from the peak's neighbours.  Together that's a few tens of milliseconds for a 60 MP frame.
+The colors of a negative differ between channels but its edges and grain don't, and phase correlation only looks at
+where the structure is, not how bright it is.
+'''
+import numpy as np
+
+#CFA color (as in rawpy's raw_pattern) of the plane used for each capture, green is the reference
+channel_colors = {'red': 0, 'green': 1, 'blue': 2}
+
+#Correlation peaks below this are too weak to trust (e.g. a blank gap between frames), so no shift is reported
+min_peak = 0.15
+#The coarse peak spreads over its neighbours whenever the shift isn't a whole number of decimated pixels, so it's weaker.
+#It's only used when the fine step fails, against its own threshold (a blank frame's noise peaks around 0.04).
+min_coarse_peak = 0.08
+
+#Decimation of the coarse step, and CFA plane pixels across the square crop of the fine step
+coarse_factor = 16
+fine_size = 256
+
+def decimate(plane, factor):
+    #Block mean.  Rows are summed first through a reshaped view, so the full-resolution plane is read once and never copied.
+    h = plane.shape[0]//factor
+    w = plane.shape[1]//factor
+    rows = plane[:h*factor, :w*factor].reshape(h, factor, w*factor).sum(axis=1, dtype=np.float32)
+    return rows.reshape(h, w, factor).sum(axis=2)/(factor*factor)
+
+def center_crop(plane, size, dy=0, dx=0):
+    #size x size from the middle of the plane moved by (dy, dx), or None if that runs off the plane
+    y = (plane.shape[0] - size)//2 + dy
+    x = (plane.shape[1] - size)//2 + dx
+    if y < 0 or x < 0 or y + size > plane.shape[0] or x + size > plane.shape[1]:
+        return None
+    return plane[y:y + size, x:x + size].astype(np.float32)
+
+def subpixel_offset(before, peak, after):
+    #Phase correlation peaks are sinc-like rather than parabolic, so use the ratio of the peak to its larger neighbour
+    if after >= before:
+        return after/(after + peak) if after > 0 else 0.0
+    return -before/(before + peak) if before > 0 else 0.0
+
+def phase_correlation(reference, moving):
+    #Returns (dy, dx, peak): the displacement of moving relative to reference, and the correlation peak height
+    window = np.outer(np.hanning(reference.shape[0]), np.hanning(reference.shape[1])).astype(np.float32)
+    a = np.fft.rfft2((reference - reference.mean())*window)
+    b = np.fft.rfft2((moving - moving.mean())*window)
+    cross = np.conj(a)*b
+    cross /= np.abs(cross) + 1e-12
+    corr = np.fft.irfft2(cross, s=reference.shape)
+    y, x = np.unravel_index(np.argmax(corr), corr.shape)
+    h, w = corr.shape
+    dy = y + subpixel_offset(corr[(y - 1) % h, x], corr[y, x], corr[(y + 1) % h, x])
+    dx = x + subpixel_offset(corr[y, (x - 1) % w], corr[y, x], corr[y, (x + 1) % w])
+    #Shifts past half the image wrap around to negative ones
+    if dy > h/2:
+        dy -= h
+    if dx > w/2:
+        dx -= w
+    return dy, dx, corr[y, x]
+
+def measure_shifts(bayer_data, pattern, factor=coarse_factor, size=fine_size):
+    #Shifts of the red and blue captures relative to green, in mosaic pixels, as {channel: (dy, dx, peak, fine)}.
+    #fine says whether the peak is from the fine step, or only from the coarse one.
+    planes = {}
+    coarse = {}
+    sites = {}
+    for channel, color in channel_colors.items():
+        row, clmn = np.argwhere(pattern == color)[0]
+        planes[channel] = bayer_data[row::2, clmn::2]
+        #Every 4th row and column is plenty for the coarse step, and reads a quarter of the rows
+        coarse[channel] = decimate(planes[channel][::4, ::4], factor//4)
+        sites[channel] = (row, clmn)
+    reference = center_crop(planes['green'], size)
+    shifts = {}
+    for channel in ('red', 'blue'):
+        #In CFA plane pixels, one step in the decimated plane is factor of them
+        dy, dx, peak = phase_correlation(coarse['green'], coarse[channel])
+        dy *= factor
+        dx *= factor
+        fine = False
+        moving = center_crop(planes[channel], size, int(round(dy)), int(round(dx)))
+        if reference is not None and moving is not None:
+            fine_dy, fine_dx, fine_peak = phase_correlation(reference, moving)
+            #A featureless middle of the frame (sky, a blank gap) leaves the coarse shift as the best there is
+            if fine_peak >= min_peak:
+                dy = round(dy) + fine_dy
+                dx = round(dx) + fine_dx
+                peak = fine_peak
+                fine = True
+        #CFA plane pixels are 2 mosaic pixels, and the planes are sampled from different CFA sites,
+        #which on its own looks like a shift of up to a pixel
+        dy = 2*dy + sites[channel][0] - sites['green'][0]
+        dx = 2*dx + sites[channel][1] - sites['green'][1]
+        shifts[channel] = (dy, dx, peak, fine)
+    return shifts
+
+def misregistered(shifts, tolerance):
+    #Channels worth re-shooting.  If red and blue have both moved the same way, it's green that moved.
+    moved = [channel for channel, (dy, dx, peak, fine) in shifts.items()
+            if peak >= (min_peak if fine else min_coarse_peak) and np.hypot(dy, dx) > tolerance]
+    if len(moved) == 2:
+        (rdy, rdx, _, _), (bdy, bdx, _, _) = shifts['red'], shifts['blue']
+        if np.hypot(rdy - bdy, rdx - bdx) <= tolerance:
+            return ['green']
+    return moved
+
+def format_shifts(shifts):
+    return ", ".join("{} dy={:+.2f} dx={:+.2f} ({}peak {:.2f})".format(channel, dy, dx, '' if fine else 'coarse ', peak)
+                    for channel, (dy, dx, peak, fine) in shifts.items())
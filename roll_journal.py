@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+'''
+Append-only JSON lines journal of a roll capture, so a roll cut short by a crash, a camera or light failure or
+Ctrl-C can be picked up again with capture_negative.py --resume.
+
+Each frame gets a 'started' record and each DNG a record of its status: 'written' once it has been renamed into
+place, or 'failed'.  Channel captures are only recorded, with the raw file and its SHA-256, if they are saved
+anyway (--keep_raw) or spooled to a directory (--spool_dir).  That's 25-60 MB per channel, so it's done by a
+background thread, and without either --resume re-captures an interrupted frame from the start.
+A frame about to be re-shot (--reshoot) gets a 'stale' DNG status first, so it isn't done until it's merged again.
+Every record is on disk before capture goes on, and a line torn by a crash is ignored when reading.
+Starting a frame again (without --resume) supersedes everything recorded for it before.
+'''
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+def data_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class RollJournal:
+    def __init__(self, path, spool_dir=None):
+        self.path = path
+        self.spool_dir = spool_dir
+        if spool_dir is not None:
+            os.makedirs(spool_dir, exist_ok=True)
+        #Writing and hashing captures would otherwise hold up the capture thread before the next channel
+        self.spooler = ThreadPoolExecutor(max_workers=1)
+        self.spooled = {}
+        #Merge workers record DNG status from their own threads
+        self.lock = threading.Lock()
+        self.frames = self.read(path)
+        self.file = open(path, 'a')
+        #Don't append to a line torn by a crash
+        if self.file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.spooler.shutdown(wait=True)
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        #Returns {output: {'frame': n, 'channels': {channel: {'file': path, 'sha256': digest}}, 'dng': status}}
+        frames = {}
+        if not os.path.exists(path):
+            return frames
+        with open(path) as f:
+            for line in f:
+                try:
+                    RollJournal.apply(frames, json.loads(line))
+                except ValueError:
+                    continue
+        return frames
+
+    @staticmethod
+    def apply(frames, entry):
+        output = entry['output']
+        if entry.get('status') == 'started' or output not in frames:
+            frames[output] = {'frame': entry.get('frame'), 'channels': {}, 'dng': None}
+        if 'channel' in entry:
+            frames[output]['channels'][entry['channel']] = {'file': entry['file'], 'sha256': entry['sha256']}
+        if 'dng' in entry:
+            frames[output]['dng'] = entry['dng']
+
+    def record(self, entry):
+        with self.lock:
+            if 'frame' not in entry and entry['output'] in self.frames:
+                entry = dict(entry, frame=self.frames[entry['output']]['frame'])
+            self.apply(self.frames, entry)
+            self.file.write(json.dumps(dict(entry, time=round(time(), 3))) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def frame_started(self, frame, output):
+        self.record({'frame': frame, 'output': output, 'status': 'started'})
+
+    def channel_captured(self, output, channel, raw_file, raw_data):
+        self.record({'output': output, 'channel': channel, 'file': raw_file, 'sha256': data_digest(raw_data)})
+
+    def spool_channel(self, output, channel, raw_data, kept_file=None):
+        #Saves a channel capture for --resume and records it in the background: kept_file if it was already saved
+        #with --keep_raw, otherwise a file in the spool directory.  Without either it isn't recorded.
+        if kept_file is None and self.spool_dir is None:
+            return
+        raw_file = kept_file or os.path.join(self.spool_dir, os.path.splitext(os.path.basename(output))[0] + '_' + channel + '.ARW')
+        def spool():
+            if kept_file is None:
+                with open(raw_file, 'wb') as f:
+                    f.write(raw_data)
+            self.channel_captured(output, channel, raw_file, raw_data)
+        self.spooled.setdefault(output, []).append(self.spooler.submit(spool))
+
+    def wait_spooled(self, output):
+        for future in self.spooled.pop(output, []):
+            if future.exception() is not None:
+                print("Couldn't spool a capture of " + output + ": " + str(future.exception()) + ", --resume will re-capture it")
+
+    def dng_status(self, output, status, error=None):
+        entry = {'output': output, 'dng': status}
+        if error is not None:
+            entry['error'] = error
+        self.record(entry)
+
+    def done(self, output):
+        return output in self.frames and self.frames[output]['dng'] == 'written' and os.path.exists(output)
+
+    def raw_files(self, output):
+        if output not in self.frames:
+            return []
+        return [c['file'] for c in self.frames[output]['channels'].values()]
+
+    def reusable_channels(self, output):
+        #Raw files of channels captured by an earlier run that are still on disk and intact, {channel: path}
+        reusable = {}
+        if output not in self.frames:
+            return reusable
+        for channel, capture in self.frames[output]['channels'].items():
+            if os.path.exists(capture['file']) and file_digest(capture['file']) == capture['sha256']:
+                reusable[channel] = capture['file']
+            else:
+                print("Captured " + channel + " for " + output + " is missing or damaged, re-capturing it")
+        return reusable
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+'''
+Hardware-free stand-ins for the camera and the Neewer light, so the capture path can be run and benchmarked
+without either.
+
+Rig mimics the parts of the gphoto2 module that CaptureSession uses (Camera(), the event and file type constants)
+and hands out SimulatedLight objects with the same interface as NeewerLight.  The camera serves real DNG buffers
+rendered from a synthetic negative lit by whatever color the light was last set to, with configurable shutter,
+transfer and light latencies, and both fakes record every command they're given with a timestamp.
+With fault_rate, triggering, downloading and light commands fail at random, to exercise the retry and resume paths.
+'''
+import io
+import os
+import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from time import sleep, monotonic
+import numpy as np
+from PIL import Image
+from dng_writer import write_dng
+from neewer_light import latency_histogram
+
+#Same values as libgphoto2
+GP_EVENT_UNKNOWN = 0
+GP_EVENT_TIMEOUT = 1
+GP_EVENT_FILE_ADDED = 2
+GP_EVENT_FOLDER_ADDED = 3
+GP_EVENT_CAPTURE_COMPLETE = 4
+GP_FILE_TYPE_PREVIEW = 0
+GP_FILE_TYPE_NORMAL = 1
+
+#Shutter speed choices as a Sony body reports them
+shutter_speeds = ['30', '15', '8', '4', '2', '1', '1/2', '1/4', '1/8', '1/15', '1/30', '1/60', '1/125', '1/250', '1/500',
+                '1/1000', '1/2000', '1/4000', 'Bulb']
+
+black_level = 512
+white_level = 16383
+
+#CFA color of each site, as in rawpy's raw_pattern
+cfa_pattern = np.array([[0, 1], [3, 2]], dtype=np.uint8)
+#Hue the light is set to for each CFA color
+cfa_hues = {0: 0, 1: 120, 3: 120, 2: 240}
+
+class GPhoto2Error(Exception):
+    #Stands in for gphoto2.GPhoto2Error
+    pass
+
+class CameraFilePath:
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+
+class CameraFile:
+    def __init__(self, data):
+        self.data = data
+
+    def get_data_and_size(self):
+        return self.data
+
+class ConfigWidget:
+    def __init__(self, name, value=None, choices=()):
+        self.name = name
+        self.value = value
+        self.choices = list(choices)
+        self.children = {}
+
+    def get_child_by_name(self, name):
+        return self.children[name]
+
+    def get_value(self):
+        return self.value
+
+    def set_value(self, value):
+        if self.choices and value not in self.choices:
+            raise ValueError(str(value) + " is not a valid choice for " + self.name)
+        self.value = value
+
+    def count_choices(self):
+        return len(self.choices)
+
+    def get_choice(self, i):
+        return self.choices[i]
+
+class Rig:
+    '''
+    shape is the raw mosaic size.  Latencies are in seconds, transfer_rate in bytes/s.
+    full_scale_exposure is the shutter speed at which a fully lit channel at brightness 100 reaches the white level.
+    '''
+    GP_EVENT_UNKNOWN = GP_EVENT_UNKNOWN
+    GP_EVENT_TIMEOUT = GP_EVENT_TIMEOUT
+    GP_EVENT_FILE_ADDED = GP_EVENT_FILE_ADDED
+    GP_EVENT_FOLDER_ADDED = GP_EVENT_FOLDER_ADDED
+    GP_EVENT_CAPTURE_COMPLETE = GP_EVENT_CAPTURE_COMPLETE
+    GP_FILE_TYPE_PREVIEW = GP_FILE_TYPE_PREVIEW
+    GP_FILE_TYPE_NORMAL = GP_FILE_TYPE_NORMAL
+    GPhoto2Error = GPhoto2Error
+
+    def __init__(self, shape=(4000, 6000), shutter_latency=0.15, transfer_rate=40e6, transfer_latency=0.05,
+                config_latency=0.05, complete_latency=0.02, light_latency=0.03, full_scale_exposure='1/30', led_gamma=1.0, seed=0,
+                fault_rate=0.0):
+        self.shape = shape
+        self.shutter_latency = shutter_latency
+        self.transfer_rate = transfer_rate
+        self.transfer_latency = transfer_latency
+        self.config_latency = config_latency
+        self.complete_latency = complete_latency
+        self.light_latency = light_latency
+        self.full_scale_exposure = Fraction(full_scale_exposure)
+        #Light output is (brightness/100)**led_gamma
+        self.led_gamma = led_gamma
+        self.seed = seed
+        #(hue, saturation, brightness) the light is currently at, set by SimulatedLight
+        self.illumination = (0, 100, 0)
+        self.negative = None
+        self.rendered = {}
+        self.previews = {}
+        self.lock = threading.Lock()
+        self.fault_rate = fault_rate
+        self.faults = random.Random(seed)
+
+    def fault(self):
+        return self.fault_rate > 0 and self.faults.random() < self.fault_rate
+
+    def check_result(self, result):
+        return result
+
+    def use_python_logging(self):
+        return None
+
+    def Camera(self):
+        return SimulatedCamera(self)
+
+    def light(self, address=None, acknowledge=True):
+        return SimulatedLight(self, address, acknowledge)
+
+    def transmission(self):
+        #A smooth, grainy per-channel transmission pattern standing in for a negative, computed once
+        if self.negative is None:
+            rng = np.random.default_rng(self.seed)
+            height, width = self.shape
+            y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+            x = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+            scene = 0.5 + 0.4*np.sin(7*x)*np.cos(5*y)
+            #Grain clumps are a few pixels across, so neighbouring CFA sites see the same clump like on real film
+            noise = rng.normal(0, 0.06, self.shape).astype(np.float32)
+            grain = np.zeros(self.shape, dtype=np.float32)
+            for dy in range(-2, 3):
+                for dx in range(-2, 3):
+                    grain += np.roll(noise, (dy, dx), axis=(0, 1))
+            scene = scene + grain/25
+            #Orange mask: the film passes much more red than blue
+            mask = {0: 0.9, 1: 0.6, 3: 0.6, 2: 0.35}
+            self.negative = np.empty(self.shape, dtype=np.float32)
+            for row in range(2):
+                for clmn in range(2):
+                    self.negative[row::2, clmn::2] = mask[cfa_pattern[row, clmn]]*scene[row::2, clmn::2]
+        return self.negative
+
+    def render(self, exposure_time):
+        #Raw mosaic for the current illumination, as a DNG buffer.  Cached, as a roll only uses a few combinations.
+        hue, sat, bright = self.illumination
+        key = (hue, bright, exposure_time)
+        with self.lock:
+            if key not in self.rendered:
+                self.rendered[key] = self.encode(self.expose(hue, bright, exposure_time), exposure_time)
+            return self.rendered[key]
+
+    def expose(self, hue, bright, exposure_time):
+        level = (white_level - black_level)*np.power(bright/100.0, self.led_gamma)*float(exposure_time/self.full_scale_exposure)
+        mosaic = np.empty(self.shape, dtype=np.float32)
+        negative = self.transmission()
+        for row in range(2):
+            for clmn in range(2):
+                #Some crosstalk into the other CFA colors, as with a real sensor and LED
+                response = 1.0 if cfa_hues[cfa_pattern[row, clmn]] == hue else 0.04
+                mosaic[row::2, clmn::2] = black_level + level*response*negative[row::2, clmn::2]
+        return np.clip(mosaic, 0, white_level).astype(np.uint16)
+
+    def encode(self, mosaic, exposure_time):
+        exposure_time = Fraction(exposure_time)
+        extratags = [('CFARepeatPatternDim', 'H', 2, cfa_pattern.shape, 0),
+                    ('CFAPattern', 'B', cfa_pattern.size, np.where(cfa_pattern == 3, 1, cfa_pattern).flatten()),
+                    ('ColorMatrix1', '2i', 9, np.array([10000, 10000, 0, 10000, 0, 10000,
+                                                        0, 10000, 10000, 10000, 0, 10000,
+                                                        0, 10000, 0, 10000, 10000, 10000], dtype=np.int32)),
+                    ('BlackLevel', 'H', 1, black_level),
+                    ('WhiteLevel', 'H', 1, white_level),
+                    ('DNGVersion', 'B', 4, [1, 4, 0, 0]),
+                    ('UniqueCameraModel', 's', 0, 'Simulated Rig')]
+        exif = {'Make': 'Simulated', 'Model': 'Rig',
+                'ExposureTime': (exposure_time.numerator, exposure_time.denominator),
+                'ISOSpeedRatings': 100}
+        #write_dng() patches the EXIF IFD in place, so it needs a real file
+        fd, path = tempfile.mkstemp(suffix='.dng')
+        os.close(fd)
+        try:
+            write_dng(path, mosaic, extratags, exif=exif)
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+    def preview(self, exposure_time):
+        #Live view JPEG of about 1000 px across, gamma encoded like a camera's
+        hue, sat, bright = self.illumination
+        key = (hue, bright, exposure_time)
+        with self.lock:
+            if key not in self.previews:
+                step = 2*max(1, self.shape[1]//2000)
+                mosaic = self.expose(hue, bright, exposure_time)
+                sites = [np.argwhere(cfa_pattern == color)[0] for color in (0, 1, 2)]
+                rgb = np.stack([mosaic[row::step, clmn::step] for row, clmn in sites], axis=-1).astype(np.float32)
+                rgb = np.clip((rgb - black_level)/(white_level - black_level), 0, 1)
+                jpeg = io.BytesIO()
+                Image.fromarray((np.power(rgb, 1/2.2)*255 + 0.5).astype(np.uint8)).save(jpeg, format='JPEG', quality=85)
+                self.previews[key] = jpeg.getvalue()
+            return self.previews[key]
+
+class SimulatedCamera:
+    def __init__(self, rig):
+        self.rig = rig
+        self.commands = []
+        self.events = []
+        self.files = {}
+        self.counter = 0
+        self.config = ConfigWidget('main')
+        self.config.children['capturetarget'] = ConfigWidget('capturetarget', 'card', ['sdram', 'card'])
+        self.config.children['shutterspeed'] = ConfigWidget('shutterspeed', '1/60', shutter_speeds)
+
+    def record(self, command, *args):
+        self.commands.append((monotonic(), command) + args)
+
+    def init(self):
+        self.record('init')
+
+    def exit(self):
+        self.record('exit')
+
+    def get_config(self):
+        return self.config
+
+    def set_config(self, config):
+        self.record('set_config', config.get_child_by_name('shutterspeed').get_value())
+        sleep(self.rig.config_latency)
+
+    def trigger_capture(self):
+        self.record('trigger_capture')
+        if self.rig.fault():
+            raise GPhoto2Error('[-7] I/O problem (simulated)')
+        exposure_time = Fraction(self.config.get_child_by_name('shutterspeed').get_value())
+        self.counter += 1
+        path = CameraFilePath('/store_00010001', 'DSC{:05d}.ARW'.format(self.counter))
+        #Rendered now, so it's the illumination at the time of the exposure
+        self.files[path.name] = self.rig.render(exposure_time)
+        done = monotonic() + float(exposure_time) + self.rig.shutter_latency
+        self.events.append((done, GP_EVENT_FILE_ADDED, path))
+        self.events.append((done + self.rig.complete_latency, GP_EVENT_CAPTURE_COMPLETE, None))
+
+    def wait_for_event(self, timeout_ms):
+        deadline = monotonic() + timeout_ms/1000.0
+        if self.events and self.events[0][0] <= deadline:
+            due, type_, data = self.events.pop(0)
+            sleep(max(0.0, due - monotonic()))
+            return type_, data
+        sleep(max(0.0, deadline - monotonic()))
+        return GP_EVENT_TIMEOUT, None
+
+    def file_get(self, folder, name, type_):
+        self.record('file_get', name)
+        if self.rig.fault():
+            raise GPhoto2Error('[-7] I/O problem (simulated)')
+        data = self.files[name]
+        sleep(self.rig.transfer_latency + len(data)/self.rig.transfer_rate)
+        return CameraFile(data)
+
+    def file_delete(self, folder, name):
+        self.record('file_delete', name)
+        del self.files[name]
+
+    def capture_preview(self):
+        self.record('capture_preview')
+        data = self.rig.preview(Fraction(self.config.get_child_by_name('shutterspeed').get_value()))
+        sleep(self.rig.transfer_latency + len(data)/self.rig.transfer_rate)
+        return CameraFile(data)
+
+class SimulatedLight:
+    '''
+    Same interface as NeewerLight.  set_HSI changes the rig's illumination after light_latency,
+    and like the real light, repeating the current command costs nothing and set_HSI(wait=False)
+    is sent from a background thread, superseding a command that hasn't been sent yet.
+    '''
+    def __init__(self, rig, address=None, acknowledge=True):
+        self.rig = rig
+        self.address = address
+        self.acknowledge = acknowledge
+        self.neewer_device = None
+        self.last_packet = None
+        self.latencies = []
+        self.commands = []
+        self.pending = None
+        self.flush_scheduled = False
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.executor.shutdown()
+
+    def find_device(self, timeout=10.0):
+        self.neewer_device = self.address or 'simulated'
+        return self.neewer_device
+
+    def send(self, packet):
+        with self.write_lock:
+            if packet == self.last_packet:
+                return None
+            if self.rig.fault():
+                raise RuntimeError('Light disconnected (simulated)')
+            start = monotonic()
+            if self.acknowledge:
+                sleep(self.rig.light_latency)
+            self.rig.illumination = packet
+            self.last_packet = packet
+            latency = monotonic() - start
+            self.latencies.append(latency)
+            return latency
+
+    def post(self, packet):
+        with self.lock:
+            self.pending = packet
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        self.executor.submit(self.flush)
+
+    def flush(self):
+        with self.lock:
+            packet = self.pending
+            self.pending = None
+            self.flush_scheduled = False
+        self.send(packet)
+
+    def set_HSI(self, hue, sat, bright, wait=True):
+        self.commands.append((monotonic(), hue, sat, bright))
+        if wait:
+            return self.send((hue, sat, bright))
+        self.post((hue, sat, bright))
+
+    def reconnect(self):
+        with self.write_lock:
+            self.last_packet = None
+
+    def latency_histogram(self):
+        return latency_histogram(self.latencies)
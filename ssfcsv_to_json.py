@@ -3,69 +3,106 @@
 '''
 Converts a CSV file exported by WebPlotDigitizer ( https://apps.automeris.io/wpd/ ) to a dcamprof camera SSF JSON
 For the time being, the column headers need fixing - Replace the empty entry to the right of Blue in the first row with Blue, etc.
+
+Given a directory, converts every *_ssf.csv in it in parallel, skipping those whose JSON is newer than the CSV
+unless --force is given.  Each JSON is written next to its CSV.
 '''
 import argparse
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import numpy as np
+from wpd_csv import interp_extrapolate, read_wpd_csv
 
-ap = argparse.ArgumentParser()
-ap.add_argument('-i', '--input', type=argparse.FileType('rb'), required=True,
-    help='path to input files')
-
-args = vars(ap.parse_args())
-
-pd.options.mode.copy_on_write = True
-
-spectral_data = pd.read_csv(args['input'], header=[0,1])
-
-'''
-WebPlotDigitizer exports in the order you added points, and has individual X values for each dataset instead of a single X column that is suitable for indexing,
-so let's do some re-sorting.
-'''
-datasets = {}
-for color in ['Red', 'Green', 'Blue']:
-    cdata = spectral_data[color]
-    cdata.rename(columns={'Y' : color}, inplace=True)
-    cdata.set_index('X', inplace=True, drop=True)
-    cdata = cdata[cdata.index.notnull()]
-    datasets[color] = cdata
-
-spectral_data = pd.concat(datasets.values()).sort_index()
-
-# https://stackoverflow.com/questions/35855772/pandas-merge-duplicate-index-into-single-index
-spectral_data = spectral_data.groupby(spectral_data.index).sum(min_count=1)
-
-# https://stackoverflow.com/questions/41493282/in-python-pandas-how-can-i-re-sample-and-interpolate-a-dataframe
 ssfstep = 5
 ssf_bands = np.arange(400,720 + ssfstep,ssfstep)
-spectral_data = spectral_data.reindex(spectral_data.index.union(ssf_bands))
-
-# https://stackoverflow.com/questions/68548971/linearly-extrapolate-pandas-dataframe-using-built-in-interpolate-method
-spectral_data.interpolate(method='slinear', fill_value="extrapolate", limit_direction="both", inplace=True)
-
-spectral_data = spectral_data.loc[ssf_bands]
-
-plt.plot(spectral_data['Red'], color='r')
-plt.plot(spectral_data['Green'], color='g')
-plt.plot(spectral_data['Blue'], color='b')
-
-plt.show()
-
-#Convert to linear values
-spectral_data = spectral_data.apply(lambda x: np.power(10,x))
-
-# Generate dcamprof spectral JSON
-filebase = os.path.splitext(args['input'].name)[0]
-jsonname = filebase + ".json"
-
-ssfdata = {'camera_name': filebase,
-           'ssf_bands': [int(ssf_bands[0]), int(ssf_bands[-1]), 5],
-           'red_ssf': spectral_data['Red'].tolist(),
-           'green_ssf': spectral_data['Green'].tolist(),
-           'blue_ssf': spectral_data['Blue'].tolist()}
 
-with open(jsonname, 'w') as jsonfile:
-    jsonfile.write(json.dumps(ssfdata, indent=4))
\ No newline at end of file
+ssf_suffix = '_ssf.csv'
+
+def resample_ssf(data):
+    #log10 sensitivities from the CSV bytes, linearly interpolated (and extrapolated at the ends) onto ssf_bands
+    columns = read_wpd_csv(data)
+    return {color: interp_extrapolate(ssf_bands, *columns[color]) for color in ['Red', 'Green', 'Blue']}
+
+def plot_ssf(spectral_data, pngname):
+    #Only imported when plotting, it's most of the run time otherwise
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    for color, c in zip(['Red', 'Green', 'Blue'], 'rgb'):
+        ax.plot(ssf_bands, spectral_data[color], color=c)
+    ax.set_xlabel('Wavelength (nm)')
+    ax.set_ylabel('Log sensitivity')
+    ax.grid()
+    fig.savefig(pngname)
+    plt.close(fig)
+
+def convert(csvname, plot=False):
+    with open(csvname, 'rb') as f:
+        spectral_data = resample_ssf(f.read())
+
+    filebase = os.path.splitext(csvname)[0]
+    if plot:
+        plot_ssf(spectral_data, filebase + ".png")
+
+    # Generate dcamprof spectral JSON, with the sensitivities converted to linear values
+    ssfdata = {'camera_name': filebase,
+               'ssf_bands': [int(ssf_bands[0]), int(ssf_bands[-1]), ssfstep],
+               'red_ssf': np.power(10, spectral_data['Red']).tolist(),
+               'green_ssf': np.power(10, spectral_data['Green']).tolist(),
+               'blue_ssf': np.power(10, spectral_data['Blue']).tolist()}
+
+    jsonname = filebase + ".json"
+    tmpname = jsonname + '.tmp'
+    with open(tmpname, 'w') as jsonfile:
+        jsonfile.write(json.dumps(ssfdata, indent=4))
+    os.replace(tmpname, jsonname)
+    return jsonname
+
+def up_to_date(csvname):
+    jsonname = os.path.splitext(csvname)[0] + ".json"
+    return os.path.exists(jsonname) and os.path.getmtime(jsonname) >= os.path.getmtime(csvname)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input', required=True,
+        help='path to input file, or a directory of *' + ssf_suffix + ' files')
+    ap.add_argument('-f', '--force', action='store_true',
+        help='convert files even if their JSON is up to date')
+    ap.add_argument('--plot', action='store_true',
+        help='also plot each SSF to a PNG next to its JSON')
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='number of conversion processes')
+
+    args = vars(ap.parse_args())
+
+    if not os.path.isdir(args['input']):
+        print(convert(args['input'], args['plot']))
+        return
+
+    csvnames = [os.path.join(args['input'], name) for name in sorted(os.listdir(args['input'])) if name.endswith(ssf_suffix)]
+    todo = csvnames if args['force'] else [c for c in csvnames if not up_to_date(c)]
+    print(str(len(csvnames)) + " files, " + str(len(csvnames) - len(todo)) + " up to date, converting " + str(len(todo)))
+    if len(todo) == 0:
+        return
+
+    failed = 0
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=args['jobs']) as executor:
+        futures = {executor.submit(convert, c, args['plot']): c for c in todo}
+        for future, csvname in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print("Failed to convert {}: {}".format(csvname, e))
+    elapsed = perf_counter() - start
+
+    print("Converted {} files in {:.2f}s".format(len(todo) - failed, elapsed))
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
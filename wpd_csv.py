@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+'''
+Reading and resampling of CSV files exported by WebPlotDigitizer ( https://apps.automeris.io/wpd/ ),
+shared by density_plot.py and ssfcsv_to_json.py.
+
+WebPlotDigitizer exports in the order you added points, with a separate X column for each dataset:
+    Red,Red,Green,Green,Blue,Blue
+    X,Y,X,Y,X,Y
+so each dataset is read as its own sorted (x, y) pair of arrays.
+'''
+import csv
+import io
+import numpy as np
+
+def read_wpd_csv(data, names=('Red', 'Green', 'Blue')):
+    #data is the file's bytes.  Returns {name: (x, y)} sorted by x, with rows missing a value dropped.
+    rows = list(csv.reader(io.StringIO(data.decode('utf-8-sig'))))
+    datasets, axes = rows[0], rows[1]
+    columns = {}
+    for name in names:
+        x_col = next(i for i in range(len(datasets)) if datasets[i] == name and axes[i] == 'X')
+        y_col = next(i for i in range(len(datasets)) if datasets[i] == name and axes[i] == 'Y')
+        points = [(float(row[x_col]), float(row[y_col])) for row in rows[2:]
+                if len(row) > max(x_col, y_col) and row[x_col].strip() and row[y_col].strip()]
+        points = np.array(sorted(points), dtype=np.float64).reshape(-1, 2)
+        columns[name] = (points[:, 0], points[:, 1])
+    return columns
+
+def interp_extrapolate(x, xp, fp):
+    #np.interp, but extrapolating linearly from the end segments instead of holding the end values
+    y = np.interp(x, xp, fp)
+    if len(xp) < 2:
+        return y
+    below = x < xp[0]
+    y[below] = fp[0] + (x[below] - xp[0])*(fp[1] - fp[0])/(xp[1] - xp[0])
+    above = x > xp[-1]
+    y[above] = fp[-1] + (x[above] - xp[-1])*(fp[-1] - fp[-2])/(xp[-1] - xp[-2])
+    return y